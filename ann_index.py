@@ -0,0 +1,237 @@
+import json
+import os
+import threading
+import numpy as np
+
+from gallery import CHANGES_FILE, distances
+import parameters as p
+
+CENTROIDS_FILE = "centroids.npy"
+ASSIGNMENTS_FILE = "assignments.npy"
+META_FILE = "meta.json"
+UPDATES_FILE = "updates.bin"  # (row, list) int32 pairs appended since assignments.npy was written
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+def nearest_centroids(data, centroids, metric, chunk_size=65536):
+    """Index of the closest centroid for every row of data, computed in bounded chunks"""
+    norms = np.linalg.norm(centroids, axis=1)
+    return np.concatenate([np.argmin(distances(data[i:i + chunk_size], centroids, metric, norms), axis=1)
+                           for i in range(0, len(data), chunk_size)]).astype(np.int32)
+
+
+def kmeans(data, num_lists, iterations, seed=0):
+    """Plain Lloyd's k-means, reseeding any list that ends up empty"""
+    rng = np.random.default_rng(seed)
+    data = np.asarray(data, dtype=np.float32)
+    centroids = data[rng.choice(len(data), num_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest_centroids(data, centroids, "euclidean")
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=num_lists)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        nonempty = counts > 0
+        sums = np.add.reduceat(data[order], starts[nonempty], axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+        centroids[~nonempty] = data[rng.choice(len(data), int((~nonempty).sum()), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """Inverted-file index over a Gallery: k-means lists of row ids, scored exactly on the gallery matrix
+
+    log_id and synced record the gallery change log and the offset in it the lists are
+    up to date with; sync() reassigns whatever rows were written after that.
+    """
+
+    def __init__(self, gallery, centroids, metric):
+        self.gallery = gallery
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.centroid_norms = np.linalg.norm(self.centroids, axis=1)
+        self.metric = metric
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.log_id = None
+        self.synced = 0
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.lists = [[] for _ in range(len(self.centroids))]
+        self._list_arrays = {}
+
+    @classmethod
+    def build(cls, gallery, num_lists=None, metric=None):
+        """Train the coarse quantizer on (a sample of) the gallery and index every row"""
+        metric = metric or p.COST_METRIC
+        # rows written while the index is built are caught up by the next sync()
+        log_id, _, _, synced = gallery.changes(float("inf"))
+        _, embeddings, _ = gallery.view()
+        num_lists = num_lists or p.ANN_NUM_LISTS or max(1, int(4 * np.sqrt(len(embeddings))))
+        num_lists = min(num_lists, len(embeddings))
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(embeddings), min(len(embeddings), p.ANN_TRAIN_SAMPLE), replace=False)
+        train = embeddings[np.sort(sample)]
+        if metric == "cosine":
+            train = normalize_rows(train)
+        index = cls(gallery, kmeans(train, num_lists, p.ANN_TRAIN_ITERATIONS), metric)
+        index.log_id, index.synced = log_id, synced
+        index.add(np.arange(len(embeddings)), embeddings)
+        return index
+
+    def sync(self, path=None):
+        """Reassign the rows the gallery wrote since the index was last synced, saving them under path
+
+        Returns False if the index does not belong to the gallery as it is now on disk.
+        """
+        changes_file = os.path.join(self.gallery.path, CHANGES_FILE)
+        with self.sync_lock:
+            if self.log_id is not None and os.path.exists(changes_file) and os.path.getsize(changes_file) == self.synced:
+                return True
+            log_id, rows, centroids, end = self.gallery.changes(self.synced)
+            if log_id != self.log_id or end < self.synced or len(self.assignments) > len(self.gallery):
+                return False
+            lists = self.add(rows, centroids)
+            self.synced = end
+            if path:
+                self.save_updates(path, rows, lists)
+            return True
+
+    def _assign(self, embeddings):
+        if self.metric == "cosine":
+            embeddings = normalize_rows(embeddings)
+        return nearest_centroids(np.asarray(embeddings, dtype=np.float32), self.centroids, "euclidean")
+
+    def add(self, rows, embeddings):
+        """Index new gallery rows, or move rows whose voiceprint was overwritten; returns their lists"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int32)
+        lists = self._assign(embeddings)
+        with self.lock:
+            if rows.max() >= len(self.assignments):
+                grown = np.full(rows.max() + 1, -1, dtype=np.int32)
+                grown[:len(self.assignments)] = self.assignments
+                self.assignments = grown
+            for row, new_list in zip(rows.tolist(), lists.tolist()):
+                old_list = self.assignments[row]
+                if old_list == new_list:
+                    continue
+                if old_list >= 0:
+                    self.lists[old_list].remove(row)
+                    self._list_arrays.pop(old_list, None)
+                self.lists[new_list].append(row)
+                self._list_arrays.pop(new_list, None)
+                self.assignments[row] = new_list
+        return lists
+
+    def list_rows(self, i):
+        rows = self._list_arrays.get(i)
+        if rows is None:
+            rows = self._list_arrays[i] = np.array(sorted(self.lists[i]), dtype=np.int64)
+        return rows
+
+    def search(self, query, k=None, nprobe=None, metric=None):
+        """Top-k (rows, distances) among the nprobe closest lists, scored exactly with metric or p.COST_METRIC"""
+        k = k or p.ANN_TOP_K
+        nprobe = min(nprobe or p.ANN_NPROBE, len(self.centroids))
+        query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        probe_query = normalize_rows(query) if self.metric == "cosine" else query
+        with self.lock:
+            probe = np.argsort(distances(probe_query, self.centroids, "euclidean", self.centroid_norms)[0])[:nprobe]
+            rows = np.concatenate([self.list_rows(i) for i in probe])
+        if len(rows) == 0:
+            return rows, np.zeros(0, dtype=np.float32)
+        rows.sort()
+        # norms of the candidates only, so a search never touches all N rows
+        scores = distances(query, self.gallery.embeddings[rows], metric or p.COST_METRIC)[0]
+        top = np.argsort(scores)[:k]
+        return rows[top], scores[top]
+
+    def save_meta(self, path):
+        tmp_file = os.path.join(path, META_FILE + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump({"metric": self.metric, "log_id": self.log_id, "synced": self.synced}, f)
+        os.replace(tmp_file, os.path.join(path, META_FILE))
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, CENTROIDS_FILE), self.centroids)
+        np.save(os.path.join(path, ASSIGNMENTS_FILE), self.assignments)
+        self.save_meta(path)
+        if os.path.exists(os.path.join(path, UPDATES_FILE)):
+            os.remove(os.path.join(path, UPDATES_FILE))
+
+    def save_updates(self, path, rows, lists):
+        """Append (row, list) pairs instead of rewriting every assignment, folding them in once the log is as long
+
+        The sync offset is saved after the pairs, so a crash in between only means a few
+        rows get reassigned again after the next load.
+        """
+        updates_file = os.path.join(path, UPDATES_FILE)
+        with open(updates_file, "ab") as f:
+            np.stack([rows, lists], axis=1).astype(np.int32).tofile(f)
+        if os.path.getsize(updates_file) // 8 > max(len(self.assignments), 1024):
+            self.save(path)
+        else:
+            self.save_meta(path)
+
+    @classmethod
+    def load(cls, gallery, path):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        index = cls(gallery, np.load(os.path.join(path, CENTROIDS_FILE)), meta["metric"])
+        # indexes saved before the gallery kept a change log have no id, so they never sync
+        index.log_id, index.synced = meta.get("log_id"), meta.get("synced", 0)
+        index.assignments = np.load(os.path.join(path, ASSIGNMENTS_FILE))
+        if os.path.exists(os.path.join(path, UPDATES_FILE)):
+            updates = np.fromfile(os.path.join(path, UPDATES_FILE), dtype=np.int32).reshape(-1, 2)
+            if len(updates) and updates[:, 0].max() >= len(index.assignments):
+                grown = np.full(updates[:, 0].max() + 1, -1, dtype=np.int32)
+                grown[:len(index.assignments)] = index.assignments
+                index.assignments = grown
+            # later pairs for the same row win, as fancy assignment keeps the last
+            index.assignments[updates[:, 0]] = updates[:, 1]
+        for row, i in enumerate(index.assignments.tolist()):
+            if i >= 0:
+                index.lists[i].append(row)
+        return index
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index(gallery):
+    """Return the process-wide index for gallery, caught up with every write to it by any process
+
+    An index saved for another gallery, or for this one before it was deleted and built
+    again, is rebuilt rather than searched.
+    """
+    global _index
+    with _index_lock:
+        if _index is not None and _index.gallery is gallery and _index.sync(p.ANN_INDEX_DIR):
+            return _index
+        _index = None
+        if os.path.exists(os.path.join(p.ANN_INDEX_DIR, META_FILE)):
+            index = IVFIndex.load(gallery, p.ANN_INDEX_DIR)
+            if index.sync(p.ANN_INDEX_DIR):
+                _index = index
+            else:
+                print("ANN index at [{}] does not match the gallery".format(p.ANN_INDEX_DIR))
+        if _index is None:
+            print("Building ANN index over {} voiceprints....".format(len(gallery)))
+            _index = IVFIndex.build(gallery)
+            _index.sync()
+            _index.save(p.ANN_INDEX_DIR)
+        return _index
+
+
+if __name__ == '__main__':
+    from gallery import get_gallery
+
+    gallery = get_gallery()
+    index = IVFIndex.build(gallery)
+    index.save(p.ANN_INDEX_DIR)
+    print("Indexed {} voiceprints into {} lists at [{}]".format(len(gallery), len(index.centroids), p.ANN_INDEX_DIR))
@@ -0,0 +1,864 @@
+# IMPORT SYSTEM FILES
+import argparse
+import glob
+import os
+import time
+import warnings
+import logging
+
+# Suppress warnings and logging
+logging.basicConfig(level=logging.ERROR)
+warnings.filterwarnings("ignore")
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # FATAL
+logging.getLogger('tensorflow').setLevel(logging.FATAL)
+
+# IMPORT USER-DEFINED FUNCTIONS
+import parameters as p
+
+WAV_GLOB = "data/wav/*/*.flac"
+
+
+# args() returns the args passed to the script
+def args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--task', help='Benchmark to run. One of: model, gallery, batch, dsp, cache, ann, service, startup, stages, metrics, quantize, backends, vad, longaudio, decode, screen, pool', required=True)
+    parser.add_argument('-f', '--files', help='Glob of audio files to benchmark with', default=WAV_GLOB)
+    parser.add_argument('-r', '--repeat', help='Number of repetitions', type=int, default=5)
+    parser.add_argument('-s', '--sizes', help='Comma-separated synthetic gallery sizes', default='10000,100000')
+    parser.add_argument('-o', '--output', help='JSON file for the stages benchmark', default='bench_stages.json')
+    parser.add_argument('--tree', help='Checkout to run the startup benchmark in, e.g. an older commit', default='.')
+    parser.add_argument('-d', '--dim', help='Embedding size of synthetic galleries', type=int, default=1024)
+    return parser.parse_args()
+
+
+def disable_caches():
+    """Turn off the in-memory spectrum and embedding caches so every call does the work"""
+    from cache import embedding_cache, spectrum_cache
+
+    for cache in (spectrum_cache, embedding_cache):
+        cache.clear()
+        cache.max_bytes = 0
+        cache.disk_dir = None
+
+
+def report(label, seconds, count):
+    print("{:<40} {:>10.4f}s total {:>10.2f}ms/call".format(label, seconds, 1000 * seconds / max(count, 1)))
+
+
+def bench_model(files, repeat):
+    """Compare loading the SavedModel per call with the resident, pre-warmed model"""
+    from feature_extraction import get_embedding
+    from model import VoiceModel, get_model
+
+    disable_caches()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        model = VoiceModel(p.MODEL_FILE)
+        get_embedding(model, files[0], p.MAX_SEC)
+    report("cold load + embed", time.perf_counter() - start, repeat)
+
+    model = get_model()
+    report("resident load", model.load_time, 1)
+    report("resident warm-up", model.warmup_time, 1)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        get_embedding(model, files[0], p.MAX_SEC)
+    report("resident embed", time.perf_counter() - start, repeat)
+
+    # Steady-state inference per bucket width, through the serving signature and the per-width functions
+    import numpy as np
+    import tensorflow as tf
+    from feature_extraction import buckets
+
+    for width in sorted(buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)):
+        batch = np.random.rand(1, p.NUM_FFT, width, 1).astype(np.float32)
+        for label, fn in (("signature", lambda: model.predict_fn(tf.constant(batch))), ("per-width", lambda: model.predict(batch))):
+            fn()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                fn()
+            report(f"{label}, width {width}", time.perf_counter() - start, repeat)
+    print("per-width functions:", model.stats())
+
+
+def bench_gallery(sizes, repeat, dim=1024):
+    """Time one identification and one claimed-identity verification against synthetic galleries, versus the per-file scalar loop"""
+    import tempfile
+    import numpy as np
+    from scipy.spatial.distance import euclidean
+    from gallery import Gallery
+
+    rng = np.random.default_rng(0)
+    probe = rng.standard_normal(dim).astype(np.float32)
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            embeddings = rng.standard_normal((size, dim)).astype(np.float32)
+            gallery = Gallery(os.path.join(tmp, "gallery"))
+            gallery.add_many([str(i) for i in range(size)], embeddings)
+            gallery = Gallery(gallery.path)
+            gallery.identify(probe)
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                gallery.identify(probe)
+            report(f"gallery identify, {size} speakers", time.perf_counter() - start, repeat)
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                gallery.verify(str(size // 2), probe)
+            report(f"gallery verify, {size} speakers", time.perf_counter() - start, repeat)
+
+            if size <= 10000:
+                embed_dir = os.path.join(tmp, "embed")
+                os.makedirs(embed_dir)
+                for i, emb in enumerate(embeddings):
+                    np.save(os.path.join(embed_dir, f"{i}.npy"), emb)
+                start = time.perf_counter()
+                distances = {}
+                for emb in os.listdir(embed_dir):
+                    distances[emb] = euclidean(probe, np.load(os.path.join(embed_dir, emb)))
+                min(distances, key=distances.get)
+                report(f"per-file loop, {size} speakers", time.perf_counter() - start, 1)
+
+
+def bench_screen(sizes, dim, probes=1024):
+    """Probes/sec of identify() one probe at a time versus top_k() over BATCH_SIZE probe blocks"""
+    import tempfile
+    import numpy as np
+
+    rng = np.random.default_rng(1)
+    queries = rng.standard_normal((probes, dim)).astype(np.float32)
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            gallery = synthetic_gallery(os.path.join(tmp, "gallery"), size, dim)
+            gallery.identify(queries[0])
+
+            start = time.perf_counter()
+            looped = [gallery.identify(query)[1] for query in queries]
+            elapsed = time.perf_counter() - start
+            print("{:<40} {:>10.1f} probes/sec".format(f"identify loop, {size} speakers", probes / elapsed))
+
+            start = time.perf_counter()
+            blocked = np.concatenate([gallery.top_k(queries[i:i + p.BATCH_SIZE], p.RECOGNIZE_TOP_K)[1][:, 0]
+                                      for i in range(0, probes, p.BATCH_SIZE)])
+            elapsed = time.perf_counter() - start
+            print("{:<40} {:>10.1f} probes/sec".format(f"top_k blocks of {p.BATCH_SIZE}, {size} speakers", probes / elapsed))
+            print("max abs difference:", float(np.abs(np.array(looped) - blocked).max()))
+
+
+def bench_batch(files, repeat):
+    """Compare files/sec of the per-file get_embedding loop with get_embedding_batch"""
+    import numpy as np
+    from feature_extraction import get_embedding, get_embedding_batch
+    from model import get_model
+
+    disable_caches()
+    model = get_model()
+    files = files * repeat
+
+    start = time.perf_counter()
+    looped = [get_embedding(model, wav_file, p.MAX_SEC) for wav_file in files]
+    elapsed = time.perf_counter() - start
+    print("{:<40} {:>10.2f} files/sec".format("get_embedding loop", len(files) / elapsed))
+
+    start = time.perf_counter()
+    batched = get_embedding_batch(model, files, p.MAX_SEC)
+    elapsed = time.perf_counter() - start
+    print("{:<40} {:>10.2f} files/sec".format(f"get_embedding_batch ({p.BATCH_SIZE})", len(files) / elapsed))
+    print("max abs difference:", max(np.abs(a - b).max() for a, b in zip(looped, batched)))
+
+
+def bench_pool(files, repeat):
+    """Files/sec of the get_embedding loop versus InferencePool with 1, 2, 4... front-end workers up to the CPU count"""
+    import numpy as np
+    from feature_extraction import get_embedding
+    from inference_pool import InferencePool, available_cpus, pool_fits
+    from model import get_model
+
+    disable_caches()
+    files = files * repeat
+    cpus = available_cpus()
+    model = get_model()
+    start = time.perf_counter()
+    looped = {wav_file: get_embedding(model, wav_file, p.MAX_SEC) for wav_file in files}
+    baseline = len(files) / (time.perf_counter() - start)
+    print("{:<40} {:>10.2f} files/sec".format("get_embedding loop", baseline))
+
+    counts = sorted({min(2**i, cpus) for i in range(cpus.bit_length() + 1)})
+    first = None
+    for workers in counts:
+        with InferencePool(dsp_workers=workers) as pool:
+            start = time.perf_counter()
+            pooled = list(pool.map((wav_file,) for wav_file in files))
+            rate = len(files) / (time.perf_counter() - start)
+        first = first or rate
+        print("{:<40} {:>10.2f} files/sec  {:>5.2f}x the 1-worker pool  {:>5.2f}x the loop".format(
+            f"pool, {workers} DSP workers", rate, rate / first, rate / baseline))
+        print("max abs difference:", max(float(np.abs(looped[wav_file] - embedding).max()) for (wav_file,), embedding, _ in pooled))
+    print(f"{cpus} CPUs available")
+    if not pool_fits():
+        print("Bulk jobs use the in-process loop here: the pool needs more than {} CPUs".format(
+            p.POOL_INFERENCE_WORKERS * p.POOL_INTRA_OP_THREADS))
+
+
+def reference_fft_spectrum(filename, buckets):
+    """The original float64, full-FFT, row-by-row spectrum kept as the accuracy reference"""
+    import numpy as np
+    from python_speech_features import sigproc
+    from preprocess import load, remove_dc_and_dither
+
+    signal = load(filename, p.SAMPLE_RATE).astype(np.float64)
+    signal *= 2**15
+    signal = remove_dc_and_dither(signal, p.SAMPLE_RATE)
+    signal = sigproc.preemphasis(signal, coeff=p.PREEMPHASIS_ALPHA)
+    frames = sigproc.framesig(signal, frame_len=p.FRAME_LEN*p.SAMPLE_RATE, frame_step=p.FRAME_STEP*p.SAMPLE_RATE, winfunc=np.hamming)
+    fft = abs(np.fft.fft(frames, n=p.NUM_FFT))
+    fft_norm = np.array([(v - np.mean(v)) / max(np.std(v), 1e-12) for v in fft.T])
+    rsize = max(k for k in buckets if k <= fft_norm.shape[1])
+    rstart = int((fft_norm.shape[1]-rsize)/2)
+    return fft_norm[:, rstart:rstart+rsize]
+
+
+def synthetic_clip(directory, seconds, seed=0):
+    """Write a noisy multi-tone clip of the given length and return its path"""
+    import numpy as np
+    import soundfile as sf
+
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * p.SAMPLE_RATE)) / p.SAMPLE_RATE
+    audio = 0.1 * np.sin(2 * np.pi * 220 * t) + 0.05 * np.sin(2 * np.pi * 1250 * t) + 0.02 * rng.standard_normal(len(t))
+    path = os.path.join(directory, f"synthetic_{seconds}s.wav")
+    sf.write(path, audio.astype(np.float32), p.SAMPLE_RATE)
+    return path
+
+
+def bench_dsp(files, repeat, atol=1e-3):
+    """Time the float32 real-FFT front end against the reference, returning the number of files that disagree"""
+    import tempfile
+    import numpy as np
+    from feature_extraction import buckets
+    from preprocess import fft_spectrum, load
+
+    def float32_spectrum(path, buckets_var):
+        return fft_spectrum(load(path, p.SAMPLE_RATE), buckets_var)
+
+    buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in files + [synthetic_clip(tmp, 10)]:
+            np.random.seed(0)
+            expected = reference_fft_spectrum(path, buckets_var)
+            np.random.seed(0)
+            actual = float32_spectrum(path, buckets_var)
+            error = np.abs(actual - expected).max()
+            if error > atol:
+                print(f"MISMATCH {path}: max abs error {error:.2e} > {atol:.0e}")
+                mismatches += 1
+
+            timings = {}
+            for label, fn in (("reference", reference_fft_spectrum), ("float32 rfft", float32_spectrum)):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    fn(path, buckets_var)
+                timings[label] = (time.perf_counter() - start) / repeat
+            print("{:<40} reference {:>8.2f}ms  float32 rfft {:>8.2f}ms  speedup {:>5.2f}x  max error {:.1e}".format(
+                os.path.basename(path), 1000 * timings["reference"], 1000 * timings["float32 rfft"],
+                timings["reference"] / timings["float32 rfft"], error))
+    return mismatches
+
+
+def bench_cache(files):
+    """Embed every file twice, as the GUI preview and enroll path do, and report cache counters"""
+    from cache import embedding_cache, spectrum_cache
+    from feature_extraction import buckets, get_embedding
+    from model import get_model
+    from preprocess import get_fft_spectrum
+
+    model = get_model()
+    buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+    for label in ("first pass", "repeat pass"):
+        start = time.perf_counter()
+        for wav_file in files:
+            get_fft_spectrum(wav_file, buckets_var)
+            get_embedding(model, wav_file, p.MAX_SEC)
+        report(label, time.perf_counter() - start, len(files))
+    print("spectrum cache:", spectrum_cache.stats())
+    print("embedding cache:", embedding_cache.stats())
+
+
+def synthetic_gallery(path, size, dim, seed=0, chunk_size=50000):
+    """Gallery of clustered random voiceprints, written in chunks to keep memory bounded"""
+    import numpy as np
+    from gallery import Gallery
+
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((max(1, size // 100), dim)).astype(np.float32)
+    gallery = Gallery(path)
+    for start in range(0, size, chunk_size):
+        count = min(chunk_size, size - start)
+        embeddings = centres[rng.integers(len(centres), size=count)] + rng.standard_normal((count, dim)).astype(np.float32)
+        gallery.add_many([str(i) for i in range(start, start + count)], embeddings)
+    return gallery
+
+
+def bench_ann(sizes, dim, queries=200, k=10):
+    """Recall@k and latency of the IVF index against the exact scan on synthetic galleries"""
+    import tempfile
+    import numpy as np
+    from ann_index import IVFIndex
+
+    rng = np.random.default_rng(1)
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            gallery = synthetic_gallery(os.path.join(tmp, "gallery"), size, dim)
+            rows = rng.integers(size, size=queries)
+            probes = gallery.embeddings[rows] + 0.8 * rng.standard_normal((queries, dim)).astype(np.float32)
+
+            start = time.perf_counter()
+            exact = [int(np.argmin(gallery.scores(probe))) for probe in probes]
+            exact_time = (time.perf_counter() - start) / queries
+
+            start = time.perf_counter()
+            index = IVFIndex.build(gallery)
+            build_time = time.perf_counter() - start
+            print(f"{size} speakers, {len(index.centroids)} lists, built in {build_time:.1f}s, "
+                  f"exact scan {1000 * exact_time:.2f}ms/query")
+            for nprobe in (1, 4, 16, 64):
+                start = time.perf_counter()
+                found = [index.search(probe, k, nprobe)[0] for probe in probes]
+                ann_time = (time.perf_counter() - start) / queries
+                recall = np.mean([truth in candidates for truth, candidates in zip(exact, found)])
+                print(f"    nprobe {nprobe:>3}: recall@{k} {recall:.3f}, {1000 * ann_time:.2f}ms/query, "
+                      f"{exact_time / ann_time:.1f}x faster than exact")
+
+
+def bench_quantize(sizes, dim, repeat, queries=200):
+    """Memory, scan time and accept/reject changes of the compact gallery encodings against float32"""
+    import tempfile
+    import numpy as np
+
+    rng = np.random.default_rng(3)
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            gallery = synthetic_gallery(os.path.join(tmp, "gallery"), size, dim)
+            # Held-out probes: noisy recordings of enrolled speakers at varying quality, plus unseen speakers
+            rows = rng.integers(size, size=queries)
+            noise = rng.uniform(0.3, 1.5, size=(queries, 1)).astype(np.float32)
+            genuine = gallery.embeddings[rows] + noise * rng.standard_normal((queries, dim)).astype(np.float32)
+            impostors = rng.standard_normal((queries, dim)).astype(np.float32) * np.abs(gallery.embeddings[rows]).mean()
+            probes = np.concatenate([genuine, impostors])
+
+            p.GALLERY_ENCODING = "float32"
+            exact = [gallery.identify(probe) for probe in probes]
+            start = time.perf_counter()
+            for _ in range(repeat):
+                gallery.scores(probes[0])
+            exact_time = (time.perf_counter() - start) / repeat
+            print(f"{size} speakers x {dim}: float32 {gallery.embeddings.nbytes / 2**20:.1f} MiB, "
+                  f"scan {1000 * exact_time:.2f}ms/query, accepted {sum(score < p.THRESHOLD for _, score in exact)}/{len(probes)}")
+
+            for encoding in ("float16", "int8"):
+                p.GALLERY_ENCODING = encoding
+                with gallery.lock:
+                    _, codes, scales, norms = gallery.compact()
+                nbytes = codes.nbytes + norms.nbytes + (0 if scales is None else scales.nbytes)
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    gallery.rerank(probes[0])
+                compact_time = (time.perf_counter() - start) / repeat
+                found = [gallery.identify(probe) for probe in probes]
+                flips = sum((a < p.THRESHOLD) != (b < p.THRESHOLD) for (_, a), (_, b) in zip(exact, found))
+                changed = sum(a != b for (a, _), (b, _) in zip(exact, found))
+                error = max(abs(a - b) for (_, a), (_, b) in zip(exact, found))
+                print(f"    {encoding:<8} {nbytes / 2**20:.1f} MiB ({gallery.embeddings.nbytes / nbytes:.1f}x smaller), "
+                      f"scan + rerank {1000 * compact_time:.2f}ms/query ({exact_time / compact_time:.2f}x), "
+                      f"decisions changed {flips}, identities changed {changed}, max score change {error:.1e}")
+            p.GALLERY_ENCODING = "float32"
+
+
+def bench_vad(files, repeat, padding=(0, 2, 5)):
+    """Frames, front-end and inference time with and without VAD, on the clips and on silence-padded copies
+
+    The similarity column compares each padded clip's embedding to that of the unpadded clip,
+    showing how much leading/trailing silence moves the voiceprint with and without VAD.
+    """
+    import numpy as np
+    from feature_extraction import buckets
+    from gallery import distances
+    from model import get_model
+    from preprocess import frame_dbfs, frame_signal, fft_spectrum, load, speech_mask
+
+    model = get_model()
+    buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+    rng = np.random.default_rng(0)
+    totals = {False: [0.0, 0], True: [0.0, 0]}
+    for path in files:
+        signal = load(path, p.SAMPLE_RATE)
+        clean = {}
+        for seconds in padding:
+            # background noise around the clip and a pause of the same length in its middle
+            def silence():
+                return 1e-4 * rng.standard_normal(int(seconds * p.SAMPLE_RATE)).astype(np.float32)
+            middle = len(signal) // 2
+            padded = np.concatenate([silence(), signal[:middle], silence(), signal[middle:], silence()])
+            frames = frame_signal(padded * 2**15)
+            kept = int(speech_mask(frame_dbfs(frames), min(buckets_var)).sum())
+            row = []
+            for enabled in (False, True):
+                p.VAD_ENABLED = enabled
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    spectrum = fft_spectrum(padded, buckets_var)
+                front_end = (time.perf_counter() - start) / repeat
+                batch = spectrum.reshape(1, *spectrum.shape, 1)
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    embedding = model.predict(batch)
+                inference = (time.perf_counter() - start) / repeat
+                clean.setdefault(enabled, embedding)
+                similarity = 1 - distances(clean[enabled], embedding, "cosine")[0, 0]
+                totals[enabled][0] += front_end + inference
+                totals[enabled][1] += 1
+                row.append("{} {:>4} cols {:>7.2f}ms sim {:.4f}".format(
+                    "vad" if enabled else "all", spectrum.shape[1], 1000 * (front_end + inference), similarity))
+            print("{:<26} +{}s  frames {:>5} -> {:>5}   {}".format(
+                os.path.basename(path), seconds, len(frames), kept, "   ".join(row)))
+    p.VAD_ENABLED = False
+    print("mean front end + inference: {:.2f}ms without VAD, {:.2f}ms with VAD".format(
+        *(1000 * total / max(count, 1) for total, count in (totals[False], totals[True]))))
+
+
+def bench_longaudio(files, minutes=(1, 10, 30)):
+    """Peak traced memory and audio-seconds/sec of sliding-window embedding as recordings get longer"""
+    import tempfile
+    import tracemalloc
+    import numpy as np
+    import soundfile as sf
+    from feature_extraction import buckets, window_embeddings
+    from model import get_model
+    from preprocess import get_fft_spectrum, load
+
+    disable_caches()
+    model = get_model()
+    speech = np.concatenate([load(path, p.SAMPLE_RATE) for path in files]).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmp:
+        for length in minutes:
+            path = os.path.join(tmp, f"long_{length}min.flac")
+            with sf.SoundFile(path, "w", p.SAMPLE_RATE, 1) as f:
+                remaining = int(length * 60 * p.SAMPLE_RATE)
+                while remaining > 0:
+                    f.write(speech[:remaining])
+                    remaining -= len(speech)
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            windows = sum(1 for _ in window_embeddings(model, path))
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("{:>3} min  streaming: {:>5} windows, peak {:>7.1f} MiB, {:>7.1f} audio-seconds/sec".format(
+                length, windows, peak / 2**20, length * 60 / elapsed))
+
+            tracemalloc.start()
+            get_fft_spectrum(path, buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("{:>3} min  whole-file get_fft_spectrum: peak {:>7.1f} MiB".format(length, peak / 2**20))
+
+
+def bench_decode(files, repeat, variants=((8000, 1), (16000, 1), (44100, 2))):
+    """librosa.load against the soundfile + polyphase decoder, on copies of the clips at telephony and web rates"""
+    import tempfile
+    import numpy as np
+    import librosa
+    import soundfile as sf
+    from preprocess import decode
+
+    totals = {"librosa": 0.0, "soundfile": 0.0}
+    with tempfile.TemporaryDirectory() as tmp:
+        for path in files:
+            original, rate = sf.read(path, dtype='float32')
+            for target_rate, channels in variants:
+                audio = librosa.resample(original, orig_sr=rate, target_sr=target_rate)
+                audio = np.stack([audio] * channels, axis=1) if channels > 1 else audio
+                copy = os.path.join(tmp, "{}_{}_{}.wav".format(os.path.basename(path), target_rate, channels))
+                sf.write(copy, audio, target_rate)
+
+                timings = {}
+                for label, fn in (("librosa", lambda: librosa.load(copy, sr=p.SAMPLE_RATE, mono=True)[0]),
+                                  ("soundfile", lambda: decode(copy, p.SAMPLE_RATE)[0])):
+                    signal = fn()
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        fn()
+                    timings[label] = (time.perf_counter() - start) / repeat
+                    totals[label] += timings[label]
+                    if label == "librosa":
+                        reference = signal
+                costs = decode(copy, p.SAMPLE_RATE)[1]
+                length = min(len(signal), len(reference))
+                correlation = np.corrcoef(signal[:length], reference[:length])[0, 1]
+                print("{:<28} {:>5}Hz x{}  librosa {:>7.2f}ms  soundfile {:>6.2f}ms ({:>5.1f}x)  "
+                      "read {:.2f}ms downmix {:.2f}ms resample {:.2f}ms  correlation {:.5f}".format(
+                          os.path.basename(path), target_rate, channels, 1000 * timings["librosa"], 1000 * timings["soundfile"],
+                          timings["librosa"] / timings["soundfile"], 1000 * costs["read"], 1000 * costs["downmix"],
+                          1000 * costs["resample"], correlation))
+    print("total: librosa {:.1f}ms, soundfile {:.1f}ms, {:.1f}x faster".format(
+        1000 * totals["librosa"], 1000 * totals["soundfile"], totals["librosa"] / totals["soundfile"]))
+
+
+BACKEND_PROBE = """
+import json, resource, sys, time
+import numpy as np
+import parameters as p
+p.WARMUP_MODEL = False
+from model import get_model, set_backend
+from feature_extraction import embed_spectra
+set_backend(sys.argv[1])
+spectra = list(np.load(sys.argv[2], allow_pickle=True))
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+model = get_model()
+load = time.perf_counter() - start
+embeddings = [model.predict(s.reshape(1, *s.shape, 1))[0] for s in spectra]
+start = time.perf_counter()
+for _ in range(int(sys.argv[4])):
+    embeddings = [model.predict(s.reshape(1, *s.shape, 1))[0] for s in spectra]
+per_call = (time.perf_counter() - start) / (int(sys.argv[4]) * len(spectra))
+np.save(sys.argv[3], np.array(embeddings))
+print(json.dumps({"load_s": load, "per_call_ms": 1000 * per_call, "rss_before_mib": before / 1024,
+                  "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+
+
+def bench_backends(files, repeat, backends=("tensorflow", "tflite", "tflite-float16", "tflite-int8"),
+                   min_similarity={"tflite": 0.9999, "tflite-float16": 0.999, "tflite-int8": 0.99}):
+    """Embeddings, latency and resident memory of every backend, each in a fresh process
+
+    The TensorFlow embeddings are the reference: every other backend must reach the given
+    cosine similarity on each clip and make the same accept/reject decision on each pair.
+    Returns the number of backends that failed to run or did not match.
+    """
+    import json
+    import subprocess
+    import sys
+    import tempfile
+    import numpy as np
+    from feature_extraction import buckets
+    from gallery import distances
+    from model import tflite_file
+    from preprocess import get_fft_spectrum
+
+    buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+    with tempfile.TemporaryDirectory() as tmp:
+        spectra_file = os.path.join(tmp, "spectra.npy")
+        spectra = np.empty(len(files), dtype=object)
+        spectra[:] = [get_fft_spectrum(filename, buckets_var) for filename in files]
+        np.save(spectra_file, spectra, allow_pickle=True)
+
+        reference = None
+        failures = 0
+        for backend in backends:
+            quantization = backend.partition("-")[2] or None
+            if backend != "tensorflow" and not os.path.exists(tflite_file(p.MODEL_FILE, quantization)):
+                print("{:<16} skipped, convert it first with: python model.py -q {}".format(backend, quantization or "none"))
+                continue
+            output = os.path.join(tmp, f"{backend}.npy")
+            run = subprocess.run([sys.executable, "-c", BACKEND_PROBE, backend, spectra_file, output, str(repeat)],
+                                 capture_output=True, text=True)
+            if run.returncode != 0:
+                print("{:<16} failed: {}".format(backend, run.stderr.strip().splitlines()[-1:]))
+                failures += 1
+                continue
+            result = json.loads(run.stdout.strip().splitlines()[-1])
+            embeddings = np.load(output)
+            line = "{:<16} load {:>6.2f}s  {:>7.2f}ms/call  peak RSS {:>7.1f} MiB ({:+.1f} MiB for the model)".format(
+                backend, result["load_s"], result["per_call_ms"], result["peak_rss_mib"],
+                result["peak_rss_mib"] - result["rss_before_mib"])
+            if reference is None:
+                reference = embeddings
+                reference_decisions = distances(reference, reference, p.COST_METRIC) < p.THRESHOLD
+                print(line, " (reference)")
+                continue
+            similarity = (1 - distances(reference, embeddings, "cosine").diagonal()).min()
+            flips = int(((distances(embeddings, embeddings, p.COST_METRIC) < p.THRESHOLD) != reference_decisions).sum() // 2)
+            ok = similarity >= min_similarity.get(backend, 0.99) and flips == 0
+            print(line, "  min cosine {:.5f}, decision flips {}  {}".format(similarity, flips, "OK" if ok else "MISMATCH"))
+            failures += not ok
+    return failures
+
+
+async def http_request(reader, writer, method, path, body=None):
+    import json
+
+    payload = json.dumps(body).encode() if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload)
+    await writer.drain()
+    await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+    return json.loads(await reader.readexactly(length))
+
+
+async def load_test(port, files, concurrency, requests_per_client):
+    import asyncio
+
+    async def client(i):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for j in range(requests_per_client):
+            await http_request(reader, writer, "POST", "/identify", {"file": os.path.abspath(files[(i + j) % len(files)])})
+        writer.close()
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    before = await http_request(reader, writer, "GET", "/stats")
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    after = await http_request(reader, writer, "GET", "/stats")
+    writer.close()
+    batches = after["batches"] - before["batches"]
+    print("concurrency {:>3}: {:>8.1f} requests/sec, mean batch size {:.2f}".format(
+        concurrency, concurrency * requests_per_client / elapsed, (after["items"] - before["items"]) / max(batches, 1)))
+
+
+def bench_service(files, repeat, port=8799):
+    """Start server.py and measure identify throughput as client concurrency grows"""
+    import asyncio
+    import socket
+    import subprocess
+    import sys
+
+    server = subprocess.Popen([sys.executable, "server.py", "--port", str(port)])
+    try:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                if server.poll() is not None:
+                    print("server.py exited before accepting connections")
+                    return
+                time.sleep(0.2)
+        for concurrency in (1, 2, 4, 8, 16, 32):
+            asyncio.run(load_test(port, files, concurrency, repeat))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+FIRST_WINDOW = """
+import time
+start = time.perf_counter()
+import tkinter as tk
+import main
+root = tk.Tk()
+main.VoiceAuthApp(root)
+root.update()
+print(time.perf_counter() - start)
+root.destroy()
+"""
+
+FIRST_SPECTROGRAM = """
+import time
+start = time.perf_counter()
+import parameters as p
+from feature_extraction import buckets
+from preprocess import get_fft_spectrum
+get_fft_spectrum({file!r}, buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP))
+print(time.perf_counter() - start)
+"""
+
+IMPORT_ONLY = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+
+def bench_startup(files, repeat, tree):
+    """Time imports, time-to-first-window and time-to-first-result in fresh interpreters"""
+    import subprocess
+    import sys
+
+    def run(command, timed_inside):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = subprocess.run(command, cwd=tree, capture_output=True, text=True)
+            elapsed = time.perf_counter() - start
+            if result.returncode != 0:
+                return None
+            timings.append(float(result.stdout.strip().splitlines()[-1]) if timed_inside else elapsed)
+        return min(timings)
+
+    checks = [
+        ("import voice_auth", [sys.executable, "-c", IMPORT_ONLY.format(module="voice_auth")], True),
+        ("import main", [sys.executable, "-c", IMPORT_ONLY.format(module="main")], True),
+        ("time to first window", [sys.executable, "-c", FIRST_WINDOW], True),
+        ("time to first spectrogram", [sys.executable, "-c", FIRST_SPECTROGRAM.format(file=os.path.abspath(files[0]))], True),
+        ("time to first result (recognize CLI)",
+         [sys.executable, "voice_auth.py", "-t", "recognize", "-f", os.path.abspath(files[0])], False),
+    ]
+    print(f"startup in [{os.path.abspath(tree)}], best of {repeat}")
+    for label, command, timed_inside in checks:
+        best = run(command, timed_inside)
+        if best is None:
+            print("{:<40} {:>10}".format(label, "failed"))
+        else:
+            print("{:<40} {:>10.3f}s".format(label, best))
+
+
+def time_stage(fn, repeat):
+    """Median and best wall time of fn, plus the peak traced allocation of one call"""
+    import statistics
+    import tracemalloc
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return result, {"median_ms": 1000 * statistics.median(times), "min_ms": 1000 * min(times), "peak_bytes": peak}
+
+
+def bench_stages(files, repeat, sizes, dim, output, lengths=(2, 5, 10, 30, 60)):
+    """Time every stage from decode to gallery scoring separately and write the results as JSON"""
+    import json
+    import subprocess
+    import tempfile
+    import numpy as np
+    from python_speech_features import sigproc
+    from feature_extraction import buckets
+    from model import get_model
+    from preprocess import bucket_slice, load, normalize_frames, remove_dc_and_dither
+    from scipy.fft import rfft
+
+    disable_caches()
+    model = get_model()
+    buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+    results = {"commit": subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip(),
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "repeat": repeat,
+               "note": "peak_bytes counts NumPy/Python allocations only, not TensorFlow's allocator",
+               "clips": [], "galleries": []}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        clips = files + [synthetic_clip(tmp, seconds) for seconds in lengths]
+        for path in clips:
+            stages = {}
+            signal, stages["load"] = time_stage(lambda: load(path, p.SAMPLE_RATE), repeat)
+            scaled = signal.astype(np.float32) * 2**15
+            filtered, stages["remove_dc_and_dither"] = time_stage(lambda: remove_dc_and_dither(scaled, p.SAMPLE_RATE), repeat)
+            emphasized, stages["preemphasis"] = time_stage(lambda: sigproc.preemphasis(filtered, coeff=p.PREEMPHASIS_ALPHA), repeat)
+            frames, stages["framesig"] = time_stage(lambda: sigproc.framesig(
+                emphasized, frame_len=p.FRAME_LEN*p.SAMPLE_RATE, frame_step=p.FRAME_STEP*p.SAMPLE_RATE, winfunc=np.hamming), repeat)
+            fft, stages["fft"] = time_stage(lambda: np.abs(rfft(frames.astype(np.float32), n=p.NUM_FFT, axis=1)), repeat)
+            fft_norm, stages["normalize_frames"] = time_stage(lambda: normalize_frames(fft.T), repeat)
+            spectrum, stages["bucket_truncation"] = time_stage(lambda: bucket_slice(fft_norm, buckets_var), repeat)
+            batch = spectrum.reshape(1, *spectrum.shape, 1)
+            _, stages["serving_signature"] = time_stage(lambda: model.predict(batch), repeat)
+            results["clips"].append({"name": os.path.basename(path), "seconds": len(signal) / p.SAMPLE_RATE,
+                                     "bucket_width": spectrum.shape[1], "stages": stages})
+            print("{:<28} {}".format(os.path.basename(path), "  ".join(
+                f"{name} {stage['median_ms']:.2f}ms" for name, stage in stages.items())))
+
+        probe = np.random.default_rng(2).standard_normal(dim).astype(np.float32)
+        for size in sizes:
+            gallery = synthetic_gallery(os.path.join(tmp, f"gallery_{size}"), size, dim)
+            gallery.identify(probe)
+            _, stage = time_stage(lambda: gallery.identify(probe), repeat)
+            results["galleries"].append({"size": size, "dim": dim, "gallery_scoring": stage})
+            print("gallery scoring, {:<10} {:.2f}ms".format(size, stage["median_ms"]))
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Wrote", output)
+
+
+def bench_metrics(files, repeat):
+    """Cost of the instrumentation hooks, disabled and enabled, on the full embedding path"""
+    import tempfile
+    import metrics
+    from feature_extraction import get_embedding
+    from model import get_model
+
+    calls = 1000000
+    start = time.perf_counter()
+    for _ in range(calls):
+        with metrics.timer("noop"):
+            pass
+    report("disabled timer()", time.perf_counter() - start, calls)
+
+    disable_caches()
+    model = get_model()
+    get_embedding(model, files[0], p.MAX_SEC)
+    with tempfile.TemporaryDirectory() as tmp:
+        for enabled, trace_log in ((False, None), (True, None), (True, os.path.join(tmp, "trace.jsonl"))):
+            p.METRICS_ENABLED, p.TRACE_LOG = enabled, trace_log
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for wav_file in files:
+                    metrics.begin_trace(file=wav_file)
+                    get_embedding(model, wav_file, p.MAX_SEC)
+                    metrics.end_trace()
+            label = "metrics {}{}".format("on" if enabled else "off", ", trace" if trace_log else "")
+            report(label, time.perf_counter() - start, repeat * len(files))
+    p.METRICS_ENABLED, p.TRACE_LOG = False, None
+    print(metrics.render().count("\n"), "lines of Prometheus text")
+
+
+if __name__ == '__main__':
+    args = args()
+    files = sorted(glob.glob(args.files))
+    if not files:
+        print("No audio files match", args.files)
+        exit()
+
+    if args.task == 'model':
+        bench_model(files, args.repeat)
+    elif args.task == 'gallery':
+        bench_gallery([int(size) for size in args.sizes.split(',')], args.repeat, args.dim)
+    elif args.task == 'batch':
+        bench_batch(files, args.repeat)
+    elif args.task == 'dsp':
+        if bench_dsp(files, args.repeat):
+            exit(1)
+    elif args.task == 'cache':
+        bench_cache(files)
+    elif args.task == 'ann':
+        bench_ann([int(size) for size in args.sizes.split(',')], args.dim)
+    elif args.task == 'service':
+        bench_service(files, args.repeat)
+    elif args.task == 'startup':
+        bench_startup(files, args.repeat, args.tree)
+    elif args.task == 'stages':
+        bench_stages(files, args.repeat, [int(size) for size in args.sizes.split(',')], args.dim, args.output)
+    elif args.task == 'metrics':
+        bench_metrics(files, args.repeat)
+    elif args.task == 'quantize':
+        bench_quantize([int(size) for size in args.sizes.split(',')], args.dim, args.repeat)
+    elif args.task == 'backends':
+        if bench_backends(files, args.repeat):
+            exit(1)
+    elif args.task == 'vad':
+        bench_vad(files, args.repeat)
+    elif args.task == 'longaudio':
+        bench_longaudio(files)
+    elif args.task == 'decode':
+        bench_decode(files, args.repeat)
+    elif args.task == 'pool':
+        bench_pool(files, args.repeat)
+    elif args.task == 'screen':
+        bench_screen([int(size) for size in args.sizes.split(',')], args.dim)
+    else:
+        print("Unknown benchmark task:", args.task)
@@ -0,0 +1,146 @@
+import csv
+import os
+import time
+from contextlib import nullcontext
+
+from feature_extraction import buckets, embed_spectra
+from gallery import check_name, get_gallery
+from inference_pool import InferencePool, pool_fits, spectrum_worker
+import parameters as p
+
+
+def read_manifest(csv_file):
+    """Yield (filename, speaker) rows from a manifest without loading it all at once"""
+    with open(csv_file, newline="") as f:
+        for row in csv.DictReader(f):
+            yield row['filename'], row['speaker']
+
+
+def read_checkpoint(checkpoint_file):
+    if not os.path.exists(checkpoint_file):
+        return set()
+    with open(checkpoint_file) as f:
+        return set(line.rstrip("\n") for line in f)
+
+
+class BulkEnroller:
+    """Collect embeddings into batches and stream them to the gallery as voiceprints"""
+
+    def __init__(self, checkpoint_file, batch_size=None):
+        self.batch_size = batch_size or p.BATCH_SIZE
+        self.gallery = get_gallery()
+        self.checkpoint_file = os.path.abspath(checkpoint_file)
+        self.batch = []
+        self.enrolled = 0
+        self.failed = 0
+
+    def add(self, filename, speaker, embedding):
+        self.batch.append((filename, speaker, embedding))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        filenames, speakers, embeddings = zip(*self.batch)
+        # Rows of the same speaker accumulate into one centroid rather than overwriting each other.
+        # The files are checkpointed (and the centroids exported) in the same gallery transaction,
+        # so after a crash a batch is either replayed from the gallery's journal or re-done, never
+        # folded in twice.
+        self.gallery.add_samples(list(speakers), list(embeddings), filenames, self.checkpoint_file, p.EMBED_LIST_FILE)
+        self.enrolled += len(self.batch)
+        self.batch = []
+
+    def close(self):
+        self.flush()
+
+
+def embed_rows(rows, batch_size=None):
+    """Yield (row, embedding, error) like InferencePool.map, decoding and embedding in this process"""
+    from model import get_model
+
+    model = get_model()
+    batch_size = batch_size or p.BATCH_SIZE
+    buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+    batch = []
+
+    def flush():
+        batch_rows, spectra = zip(*batch)
+        batch.clear()
+        try:
+            embeddings = embed_spectra(model, list(spectra), batch_size)
+        except Exception as e:
+            return [(row, None, str(e)) for row in batch_rows]
+        return [(row, embedding, None) for row, embedding in zip(batch_rows, embeddings)]
+
+    for row in rows:
+        try:
+            spectrum = spectrum_worker(row[0], buckets_var)
+        except Exception as e:
+            yield row, None, str(e)
+            continue
+        batch.append((row, spectrum))
+        if len(batch) >= batch_size:
+            yield from flush()
+    if batch:
+        yield from flush()
+
+
+def iter_embeddings(rows, workers=None):
+    """Yield (row, embedding, error) for rows whose first field is a filename, in completion order
+
+    With p.BULK_USE_POOL, and CPUs for both its inference and front-end workers, files go
+    through an InferencePool, so spectra stay in shared memory and only the embeddings
+    come back. Otherwise they are decoded and embedded in batches in this process.
+    Failures are printed and yielded with embedding None.
+    """
+    use_pool = p.BULK_USE_POOL and pool_fits()
+    with InferencePool(dsp_workers=workers) if use_pool else nullcontext() as pool:
+        for row, embedding, error in pool.map(rows) if use_pool else embed_rows(rows):
+            if error is not None:
+                print(f"Error processing the input audio file {row[0]}: {error}")
+            yield row, embedding, error
+
+
+def report_progress(verb, done, failed, total, start):
+    elapsed = time.perf_counter() - start
+    print("{} {}/{} files ({} failed), {:.1f} files/sec".format(verb, done, total, failed, done / max(elapsed, 1e-9)))
+
+
+def enroll_manifest(csv_file, workers=None, batch_size=None):
+    """Enroll every row of a filename,speaker manifest, resuming from csv_file.done if present"""
+    checkpoint_file = csv_file + ".done"
+    # A batch interrupted mid-write is finished first, which also checkpoints its files
+    get_gallery().recover()
+    done = read_checkpoint(checkpoint_file)
+    total = sum(1 for filename, _ in read_manifest(csv_file) if filename not in done)
+    if done:
+        print(f"Resuming: {len(done)} files already enrolled, {total} to go")
+
+    enroller = BulkEnroller(checkpoint_file, batch_size)
+    start = time.perf_counter()
+
+    def rows():
+        for filename, speaker in read_manifest(csv_file):
+            if filename in done:
+                continue
+            try:
+                check_name(speaker)
+            except ValueError as e:
+                # counted like unreadable audio, so one bad row cannot sink the batch it would land in
+                print(f"Skipping {filename}: {e}")
+                enroller.failed += 1
+                continue
+            yield filename, speaker
+
+    for seen, ((filename, speaker), embedding, error) in enumerate(iter_embeddings(rows(), workers), 1):
+        if error is None:
+            enroller.add(filename, speaker, embedding)
+        else:
+            # failed files are not checkpointed, so a resumed run tries them again
+            enroller.failed += 1
+        if seen % p.BULK_REPORT_EVERY == 0:
+            report_progress("Enrolled", enroller.enrolled, enroller.failed, total, start)
+    enroller.close()
+    report_progress("Enrolled", enroller.enrolled, enroller.failed, total, start)
+    return enroller.enrolled, enroller.failed
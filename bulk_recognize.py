@@ -0,0 +1,166 @@
+import csv
+import json
+import os
+import time
+import numpy as np
+
+from bulk_enroll import iter_embeddings, report_progress
+from gallery import get_gallery
+import metrics
+import parameters as p
+
+
+def read_probes(csv_file):
+    """Yield the filename column of a probe list without loading it all at once"""
+    with open(csv_file, newline="") as f:
+        for row in csv.DictReader(f):
+            yield row['filename']
+
+
+def trim_results(output, chunk_size=65536):
+    """Cut off a last line left unfinished by a killed run, so the file ends on a complete record"""
+    if not os.path.exists(output):
+        return
+    with open(output, "rb+") as f:
+        size = end = f.seek(0, os.SEEK_END)
+        keep = 0
+        # only the tail is read, back to the last newline
+        while end > 0:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                keep = start + newline + 1
+                break
+            end = start
+        if keep < size:
+            f.truncate(keep)
+
+
+def parse_jsonl(f):
+    for line in f:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+
+def read_results(output):
+    """Filenames already recognized in a CSV or JSONL results file, so an interrupted run resumes
+
+    Lines with an error, or that do not parse, do not count, so like bulk enrollment a
+    resumed run retries those files.
+    """
+    if not os.path.exists(output):
+        return set()
+    with open(output, newline="") as f:
+        if output.endswith(".jsonl"):
+            rows = parse_jsonl(f)
+        else:
+            rows = csv.DictReader(f)
+        return set(row["filename"] for row in rows if not row["error"])
+
+
+class ResultWriter:
+    """Append one line per probe to a CSV file, or a JSONL file if the name ends in .jsonl"""
+
+    def __init__(self, output, k):
+        self.jsonl = output.endswith(".jsonl")
+        new = not os.path.exists(output) or os.path.getsize(output) == 0
+        self.f = open(output, "a", newline="")
+        if not self.jsonl:
+            self.writer = csv.writer(self.f)
+            if new:
+                header = ["filename", "speaker", "score", "accepted", "error"]
+                for i in range(1, k + 1):
+                    header += [f"name_{i}", f"score_{i}"]
+                self.writer.writerow(header)
+
+    def write(self, filename, names=(), scores=(), error=""):
+        accepted = bool(len(scores) and scores[0] < p.THRESHOLD)
+        speaker = names[0] if accepted else ""
+        if self.jsonl:
+            self.f.write(json.dumps({"filename": filename, "speaker": speaker or None,
+                                     "score": float(scores[0]) if len(scores) else None, "accepted": accepted,
+                                     "error": error or None,
+                                     "top": [{"name": name, "score": float(score)} for name, score in zip(names, scores)]}) + "\n")
+        else:
+            row = [filename, speaker, f"{scores[0]:.6f}" if len(scores) else "", int(accepted), error]
+            for name, score in zip(names, scores):
+                row += [name, f"{score:.6f}"]
+            self.writer.writerow(row)
+
+    def flush(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class BulkRecognizer:
+    """Collect probe embeddings into batches and score each batch against the whole gallery at once"""
+
+    def __init__(self, output, k=None, batch_size=None):
+        self.batch_size = batch_size or p.BATCH_SIZE
+        self.k = k or p.RECOGNIZE_TOP_K
+        self.gallery = get_gallery()
+        self.writer = ResultWriter(output, self.k)
+        self.batch = []
+        self.recognized = 0
+        self.accepted = 0
+        self.failed = 0
+
+    def add(self, filename, embedding):
+        self.batch.append((filename, embedding))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def fail(self, filename, error):
+        self.failed += 1
+        self.writer.write(filename, error=str(error))
+
+    def flush(self):
+        if not self.batch:
+            return
+        filenames, embeddings = zip(*self.batch)
+        embeddings = np.array(embeddings, dtype=np.float32)
+        rows, scores = self.gallery.top_k(embeddings.reshape(len(filenames), -1), self.k)
+        for filename, probe_rows, probe_scores in zip(filenames, rows, scores):
+            self.writer.write(filename, [self.gallery.names[row] for row in probe_rows], probe_scores)
+            self.accepted += int(probe_scores[0] < p.THRESHOLD)
+            metrics.observe(metrics.scores, float(probe_scores[0]))
+        metrics.observe(metrics.gallery_scanned, len(self.gallery))
+
+        # Results reach the disk batch by batch, so a crash only re-does the batch in flight
+        self.writer.flush()
+        self.recognized += len(self.batch)
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def recognize_manifest(csv_file, output, k=None, workers=None, batch_size=None):
+    """Identify every file of a probe list, streaming top-k results to output and resuming from it if present"""
+    trim_results(output)
+    done = read_results(output)
+    total = sum(1 for filename in read_probes(csv_file) if filename not in done)
+    if done:
+        print(f"Resuming: {len(done)} files already in {output}, {total} to go")
+
+    recognizer = BulkRecognizer(output, k, batch_size)
+    start = time.perf_counter()
+    rows = ((filename,) for filename in read_probes(csv_file) if filename not in done)
+    for seen, ((filename,), embedding, error) in enumerate(iter_embeddings(rows, workers), 1):
+        if error is None:
+            recognizer.add(filename, embedding)
+        else:
+            recognizer.fail(filename, error)
+        if seen % p.BULK_REPORT_EVERY == 0:
+            report_progress("Recognized", recognizer.recognized, recognizer.failed, total, start)
+    recognizer.close()
+    report_progress("Recognized", recognizer.recognized, recognizer.failed, total, start)
+    return recognizer.recognized, recognizer.accepted, recognizer.failed
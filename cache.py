@@ -0,0 +1,118 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+import parameters as p
+
+
+class ArrayCache:
+    """LRU cache of NumPy arrays with a byte budget and an optional on-disk tier"""
+
+    def __init__(self, max_bytes, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.disk_dir and os.path.exists(os.path.join(self.disk_dir, key + ".npy")):
+            value = np.load(os.path.join(self.disk_dir, key + ".npy"))
+            self._remember(key, value)
+            with self.lock:
+                self.disk_hits += 1
+            return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        value = np.asarray(value)
+        self._remember(key, value)
+        if self.disk_dir:
+            # write then rename so concurrent readers never see a partial file
+            tmp_file = os.path.join(self.disk_dir, f"{key}.{threading.get_ident()}.tmp.npy")
+            np.save(tmp_file, value)
+            os.replace(tmp_file, os.path.join(self.disk_dir, key + ".npy"))
+
+    def _remember(self, key, value):
+        # cached arrays are shared between callers, so they must not be modified in place
+        value.flags.writeable = False
+        if value.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key).nbytes
+            self.entries[key] = value
+            self.bytes += value.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "entries": len(self.entries), "bytes": self.bytes}
+
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(filename):
+    """Hash of a file's content, remembered while its size and mtime are unchanged"""
+    stat = os.stat(filename)
+    stamp = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    with _digests_lock:
+        if stamp in _digests:
+            return _digests[stamp]
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    with _digests_lock:
+        _digests[stamp] = digest.hexdigest()
+    return _digests[stamp]
+
+
+def audio_digest(source, sample_rate=None):
+    """Hash of an audio file, or of an in-memory buffer together with its sample rate"""
+    if isinstance(source, np.ndarray):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{source.dtype}{source.shape}{sample_rate}".encode())
+        digest.update(np.ascontiguousarray(source).data)
+        return digest.hexdigest()
+    return file_digest(source)
+
+
+def spectrum_key(audio_digest, buckets):
+    """Key of a spectrum: the audio content plus every parameter the front end depends on"""
+    settings = (p.SAMPLE_RATE, p.PREEMPHASIS_ALPHA, p.FRAME_LEN, p.FRAME_STEP, p.NUM_FFT, sorted(buckets),
+                p.VAD_ENABLED and (p.VAD_DBFS, p.VAD_RELATIVE_DB, p.VAD_HANGOVER_FRAMES))
+    return hashlib.blake2b(f"{audio_digest}{settings}".encode(), digest_size=16).hexdigest()
+
+
+def embedding_key(spectrum_key, model_identity):
+    """Key of an embedding: the spectrum it came from plus the model that produced it"""
+    return hashlib.blake2b(f"{spectrum_key}{model_identity}".encode(), digest_size=16).hexdigest()
+
+
+spectrum_cache = ArrayCache(p.SPECTRUM_CACHE_BYTES, p.CACHE_DIR and os.path.join(p.CACHE_DIR, "spectra"))
+embedding_cache = ArrayCache(p.EMBEDDING_CACHE_BYTES, p.CACHE_DIR and os.path.join(p.CACHE_DIR, "embeddings"))
@@ -0,0 +1,159 @@
+# IMPORT SYSTEM FILES
+import argparse
+import json
+import os
+import time
+import warnings
+import logging
+import numpy as np
+
+# Suppress warnings and logging
+logging.basicConfig(level=logging.ERROR)
+warnings.filterwarnings("ignore")
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # FATAL
+logging.getLogger('tensorflow').setLevel(logging.FATAL)
+
+# IMPORT USER-DEFINED FUNCTIONS
+from bulk_enroll import iter_embeddings, read_manifest, report_progress
+from cache import embedding_key, file_digest, spectrum_key
+from feature_extraction import buckets
+from gallery import distances
+from model import model_identity, set_backend, tflite_file
+import parameters as p
+
+# Bytes held per (probe, enrolled) pair while a block is scored: dots, norms, distances, masks and bin indices
+BYTES_PER_PAIR = 32
+
+
+def embed_manifest(csv_file, workers=None):
+    """Embed every row of a filename,speaker list once, returning (filenames, speakers, embeddings)"""
+    total = sum(1 for _ in read_manifest(csv_file))
+    filenames, speakers, embeddings = [], [], []
+    start = time.perf_counter()
+    failed = 0
+    for seen, ((filename, speaker), embedding, error) in enumerate(iter_embeddings(read_manifest(csv_file), workers), 1):
+        if error is None:
+            filenames.append(filename)
+            speakers.append(speaker)
+            embeddings.append(embedding)
+        else:
+            failed += 1
+        if seen % p.BULK_REPORT_EVERY == 0:
+            report_progress("Embedded", seen - failed, failed, total, start)
+    return filenames, speakers, np.array(embeddings, dtype=np.float32).reshape(len(filenames), -1)
+
+
+def embeddings_key(csv_file):
+    """Key of a list's saved embeddings: the list's content, the front-end settings and the model of the backend"""
+    model_file = p.MODEL_FILE if p.MODEL_BACKEND == "tensorflow" else tflite_file(p.MODEL_FILE, p.TFLITE_QUANTIZATION)
+    key = spectrum_key(file_digest(csv_file), buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP))
+    return embedding_key(key, model_identity(model_file))
+
+
+def score_histograms(embeddings, labels, metric, bins, memory_mb):
+    """Histograms of genuine and impostor distances over every unordered pair, one row block at a time"""
+    norms = np.linalg.norm(embeddings, axis=1)
+    high = 2.0 if metric == "cosine" else 2 * float(norms.max())
+    width = high / bins
+    genuine = np.zeros(bins, dtype=np.int64)
+    impostor = np.zeros(bins, dtype=np.int64)
+    total = len(embeddings)
+    block = max(1, int(memory_mb * 2**20 / (BYTES_PER_PAIR * max(total, 1))))
+
+    for start in range(0, total, block):
+        stop = min(start + block, total)
+        # Only pairs (i, j) with j > i, so every pair is scored once and self-pairs never
+        scores = distances(embeddings[start:stop], embeddings[start:], metric, norms[start:])
+        upper = np.arange(start, total)[None, :] > np.arange(start, stop)[:, None]
+        same = labels[start:stop, None] == labels[None, start:]
+        index = np.minimum((scores / width).astype(np.int32), bins - 1)
+        genuine += np.bincount(index[upper & same], minlength=bins)
+        impostor += np.bincount(index[upper & ~same], minlength=bins)
+    return np.arange(1, bins + 1) * width, genuine, impostor
+
+
+def error_rates(genuine, impostor):
+    """False accept and false reject rates when distances below each threshold are accepted"""
+    far = np.cumsum(impostor) / max(impostor.sum(), 1)
+    frr = 1 - np.cumsum(genuine) / max(genuine.sum(), 1)
+    return far, frr
+
+
+def summarize(thresholds, genuine, impostor, points=200):
+    far, frr = error_rates(genuine, impostor)
+    eer_index = int(np.argmin(np.abs(far - frr)))
+    recommended = {"eer": float(thresholds[eer_index])}
+    for target in (0.01, 0.001):
+        # largest threshold whose false accept rate stays within target
+        within = np.nonzero(far <= target)[0]
+        recommended[f"far_{target:g}"] = float(thresholds[within[-1]]) if len(within) else None
+    current = min(int(np.searchsorted(thresholds, p.THRESHOLD)), len(thresholds) - 1)
+    # DET/ROC points evenly spaced from the last threshold without false accepts to the first without false rejects
+    lo = max(int(np.argmax(far > 0)) - 1, 0)
+    hi = int(np.argmax(frr <= 0)) if (frr <= 0).any() else len(thresholds) - 1
+    curve = np.unique(np.linspace(lo, max(hi, lo), points).astype(int))
+    return {"genuine_pairs": int(genuine.sum()), "impostor_pairs": int(impostor.sum()),
+            "eer": float((far[eer_index] + frr[eer_index]) / 2), "thresholds": recommended,
+            "at_current_threshold": {"threshold": p.THRESHOLD, "far": float(far[current]), "frr": float(frr[current])},
+            "det": [{"threshold": float(thresholds[i]), "far": float(far[i]), "frr": float(frr[i])} for i in curve],
+            "roc": [{"threshold": float(thresholds[i]), "far": float(far[i]), "tpr": float(1 - frr[i])} for i in curve]}
+
+
+def evaluate(embeddings, speakers, metrics, bins=None, memory_mb=None):
+    """EER, DET/ROC curves and recommended thresholds for each metric"""
+    _, labels = np.unique(np.asarray(speakers), return_inverse=True)
+    results = {}
+    for metric in metrics:
+        start = time.perf_counter()
+        thresholds, genuine, impostor = score_histograms(embeddings, labels, metric,
+                                                         bins or p.EVAL_BINS, memory_mb or p.EVAL_MEMORY_MB)
+        results[metric] = summarize(thresholds, genuine, impostor)
+        results[metric]["seconds"] = time.perf_counter() - start
+    return results
+
+
+# args() returns the args passed to the script
+def args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--file', help='CSV list of filename,speaker rows to evaluate on', required=True)
+    parser.add_argument('-m', '--metrics', help='Comma-separated cost metrics to evaluate', default='cosine,euclidean')
+    parser.add_argument('-o', '--output', help='JSON file for the full results', default='evaluation.json')
+    parser.add_argument('--backend', help='Inference backend: tensorflow, tflite, tflite-float16 or tflite-int8', default=None)
+    parser.add_argument('--memory-mb', help='Memory cap for a block of pair scores', type=int, default=p.EVAL_MEMORY_MB)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = args()
+    if args.backend:
+        try:
+            set_backend(args.backend)
+        except ValueError as e:
+            print(e)
+            exit()
+    # The embeddings are kept next to the list, so re-running with other metrics skips the model.
+    # They are only reused while the list, the front-end settings and the model are all unchanged.
+    embed_file = "{}.{}.embeddings.npz".format(args.file, args.backend or p.MODEL_BACKEND)
+    key = embeddings_key(args.file)
+    saved = np.load(embed_file) if os.path.exists(embed_file) else None
+    if saved is not None and "key" in saved.files and str(saved["key"]) == key:
+        print("Loading embeddings from [{}]....".format(embed_file))
+        speakers, embeddings = saved["speakers"], saved["embeddings"]
+    else:
+        if saved is not None:
+            print("Embeddings in [{}] are out of date".format(embed_file))
+        print("Embedding [{}]....".format(args.file))
+        filenames, speakers, embeddings = embed_manifest(args.file)
+        np.savez(embed_file, filenames=filenames, speakers=speakers, embeddings=embeddings, key=key)
+
+    print("Scoring {} utterances of {} speakers....".format(len(embeddings), len(set(speakers))))
+    results = evaluate(embeddings, speakers, args.metrics.split(','), memory_mb=args.memory_mb)
+    for metric, result in results.items():
+        thresholds = {name: "-" if value is None else f"{value:.4f}" for name, value in result["thresholds"].items()}
+        print("{:<10} EER {:.2%}  threshold at EER {}  FAR 1% {}  FAR 0.1% {}  ({:.1f}s)".format(
+            metric, result["eer"], thresholds["eer"], thresholds["far_0.01"], thresholds["far_0.001"], result["seconds"]))
+        current = result["at_current_threshold"]
+        print("{:<10} at p.THRESHOLD {}: FAR {:.2%}  FRR {:.2%}".format("", current["threshold"], current["far"], current["frr"]))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Wrote", args.output)
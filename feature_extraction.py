@@ -1,14 +1,16 @@
 import os
+from functools import lru_cache
 import numpy as np
-import pandas as pd
-from scipy.spatial.distance import cdist, euclidean, cosine
-import tensorflow as tf 
 
+from cache import audio_digest, embedding_cache, embedding_key, spectrum_key
 from preprocess import get_fft_spectrum
+import metrics
 import parameters as p
 
 
+@lru_cache(maxsize=None)
 def buckets(max_time, steptime, frameskip):
+    """Spectrogram widths the model accepts, computed once per setting; the dict is shared, do not modify it"""
     buckets = {}
     frames_per_sec = int(1/frameskip)
     end_frame = int(max_time*frames_per_sec)
@@ -29,36 +31,114 @@ def buckets(max_time, steptime, frameskip):
     return buckets
 
 
-def get_embedding(model, wav_file, max_time):
+def get_embedding(model, wav_file, max_time, sample_rate=None, progress=None):
     buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
-    signal = get_fft_spectrum(wav_file, buckets_var)
-    
-    # Convert to TensorFlow tensor and reshape
-    input_tensor = tf.constant(signal.reshape(1, *signal.shape, 1), dtype=tf.float32)
-    
-    # Get the output
-    outputs = model.signatures['serving_default'](input_tensor)
-    
-    # Handle different output formats
-    if len(outputs) == 1:
-        # If only one output, use it regardless of name
-        embedding = list(outputs.values())[0]
-    else:
-        # Try common output names
-        for possible_name in ['output_0', 'embedding', 'output', 'predictions']:
-            if possible_name in outputs:
-                embedding = outputs[possible_name]
-                break
-        else:
-            raise ValueError(f"Could not identify output layer. Available outputs: {list(outputs.keys())}")
+    key = embedding_key(spectrum_key(audio_digest(wav_file, sample_rate), buckets_var), model.identity)
+    embedding = embedding_cache.get(key)
+    if embedding is not None:
+        return embedding
+
+    with metrics.timer("embedding"):
+        signal = get_fft_spectrum(wav_file, buckets_var, sample_rate, progress)
+        if progress:
+            progress("inference")
+
+        # Reshape to a batch of one and run it through the resident model
+        with metrics.timer("inference"):
+            embedding = np.squeeze(model.predict(signal.reshape(1, *signal.shape, 1)))
+    embedding_cache.put(key, embedding)
     
-    return np.squeeze(embedding.numpy())
+    return embedding
+
+def embed_spectra(model, spectra, batch_size=None):
+    """Embed spectrograms in input order, with one model call per bucket width and batch"""
+    batch_size = batch_size or p.BATCH_SIZE
+    groups = {}
+    for i, spectrum in enumerate(spectra):
+        groups.setdefault(spectrum.shape[1], []).append(i)
+
+    embeddings = [None] * len(spectra)
+    for indices in groups.values():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            batch = np.stack([spectra[i] for i in chunk])[..., np.newaxis]
+            for i, embedding in zip(chunk, model.predict(batch)):
+                embeddings[i] = embedding
+    return embeddings
+
+
+def get_embedding_batch(model, wav_files, max_time, batch_size=None):
+    buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+    keys = [embedding_key(spectrum_key(audio_digest(wav_file), buckets_var), model.identity) for wav_file in wav_files]
+    embeddings = [embedding_cache.get(key) for key in keys]
 
-def get_embedding_batch(model, wav_files, max_time):
-    return [ get_embedding(model, wav_file, max_time) for wav_file in wav_files ]
+    # only the files that missed the cache go through the model
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    spectra = [get_fft_spectrum(wav_files[i], buckets_var) for i in missing]
+    for i, embedding in zip(missing, embed_spectra(model, spectra, batch_size)):
+        embedding_cache.put(keys[i], embedding)
+        embeddings[i] = embedding
+    return embeddings
+
+
+def window_embeddings(model, filename, window_sec=None, hop_sec=None, batch_size=None, progress=None):
+    """Yield (start_sec, end_sec, embedding) for sliding windows over a long recording
+
+    Audio is read and transformed block by block, and only one window of spectrogram
+    columns is kept, so memory does not depend on the recording's length. The window is
+    rounded down to a bucket width and the hop to whole frames. Windows with less than
+    p.STREAM_MIN_VOICED of their frames above p.VOICED_DBFS are skipped.
+    progress, if given, is called with the seconds of audio read so far after every block.
+    """
+    from preprocess import StreamingSpectrum, bucket_slice, normalize_frames, read_blocks
+
+    buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+    batch_size = batch_size or p.BATCH_SIZE
+    frames_per_sec = int(1/p.FRAME_STEP)
+    window_frames = int((window_sec or p.STREAM_WINDOW_SEC) * frames_per_sec)
+    window = max([width for width in buckets_var if width <= window_frames] or [min(buckets_var)])
+    hop = max(1, int(round((hop_sec or p.STREAM_HOP_SEC) * frames_per_sec)))
+
+    stream = StreamingSpectrum()
+    columns = np.zeros((0, p.NUM_FFT // 2 + 1), dtype=np.float32)
+    levels = np.zeros(0, dtype=np.float32)
+    offset = 0  # frame index of columns[0]
+    skip = 0  # frames still to drop when the hop is longer than the window
+    pending = []
+    read = 0
+
+    def flush():
+        embeddings = model.predict(np.stack([spectrum for _, spectrum in pending])[..., np.newaxis])
+        for (start, _), embedding in zip(pending, embeddings):
+            yield start * p.FRAME_STEP, (start + window) * p.FRAME_STEP, embedding
+        pending.clear()
+
+    for block in read_blocks(filename):
+        read += len(block)
+        if progress:
+            progress(read / p.SAMPLE_RATE)
+        stream.feed(block)
+        fft, new_levels = stream.drain()
+        dropped = min(skip, len(fft))
+        skip -= dropped
+        columns = np.concatenate([columns, fft[dropped:]])
+        levels = np.concatenate([levels, new_levels[dropped:]])
+
+        while len(columns) >= window:
+            if np.mean(levels[:window] > p.VOICED_DBFS) >= p.STREAM_MIN_VOICED:
+                pending.append((offset, bucket_slice(normalize_frames(columns[:window].T), buckets_var)))
+            skip = max(hop - len(columns), 0)
+            columns, levels = columns[hop:], levels[hop:]
+            offset += hop
+        if len(pending) >= batch_size:
+            yield from flush()
+    if pending:
+        yield from flush()
 
 
 def get_embeddings_from_list_file(model, list_file, max_time):
+    import pandas as pd
+
     buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
     result = pd.read_csv(list_file, delimiter=",")
     result['features'] = result['filename'].apply(lambda x: get_fft_spectrum(x, buckets_var))
@@ -0,0 +1,562 @@
+import json
+import os
+import threading
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows, where only the in-process lock is taken
+    fcntl = None
+
+import metrics
+import parameters as p
+
+EMBEDDINGS_FILE = "embeddings.npy"
+NAMES_FILE = "names.json"
+STATS_FILE = "stats.npy"
+JOURNAL_FILE = "journal.npz"
+# Every written row as int32, appended in write order after an 8-byte id that is new for every gallery
+CHANGES_FILE = "changes.bin"
+CHANGES_HEADER = 8
+LOCK_FILE = "lock"
+# Compact scan copies kept next to embeddings.npy: codes, and a (capacity, 2) array of per-row scale and norm
+COMPACT_DTYPES = {"float16": np.float16, "int8": np.int8}
+MIN_CAPACITY = 1024
+
+
+def check_name(name):
+    """Return name if it is safe as a speaker name and file stem, else raise ValueError"""
+    if not isinstance(name, str) or not name.strip() or ".." in name or "\0" in name \
+            or any(sep in name for sep in ("/", "\\", os.sep, os.altsep) if sep):
+        raise ValueError(f"Invalid speaker name: {name!r}")
+    return name
+
+
+def export_voiceprint(export_dir, name, centroid):
+    """Write one speaker's centroid to <export_dir>/<name>.npy, replacing any old file atomically"""
+    os.makedirs(export_dir, exist_ok=True)
+    tmp_file = os.path.join(export_dir, f".{check_name(name)}.npy.tmp")
+    with open(tmp_file, "wb") as f:
+        np.save(f, centroid)
+    os.replace(tmp_file, os.path.join(export_dir, f"{name}.npy"))
+
+
+def distances(queries, matrix, metric, norms=None):
+    """Distances between every query row and every gallery row, shape (num_queries, num_enrolled)"""
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    if norms is None:
+        norms = np.linalg.norm(matrix, axis=1)
+    return distances_from_dots(queries @ matrix.T, np.linalg.norm(queries, axis=1), norms, metric)
+
+
+def distances_from_dots(dots, query_norms, norms, metric):
+    if metric == "cosine":
+        return 1 - dots / np.maximum(np.outer(query_norms, norms), 1e-12)
+    elif metric == "euclidean":
+        squared = query_norms[:, None]**2 - 2 * dots + norms[None, :]**2
+        return np.sqrt(np.maximum(squared, 0))
+    raise ValueError(f"Unknown cost metric: {metric}")
+
+
+def encode(embeddings, encoding):
+    """Compact copy of float32 rows: float16, or int8 codes with one scale per row"""
+    if encoding == "float16":
+        return embeddings.astype(np.float16), None
+    elif encoding == "int8":
+        scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127
+        codes = np.round(embeddings / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"Unknown gallery encoding: {encoding}")
+
+
+def decode_chunks(codes, chunk_size=256):
+    """Yield (start, float32 block) over encoded rows, reusing one cache-sized buffer"""
+    buffer = np.empty((chunk_size, codes.shape[1]), dtype=np.float32)
+    for i in range(0, len(codes), chunk_size):
+        block = buffer[:len(codes[i:i + chunk_size])]
+        np.copyto(block, codes[i:i + chunk_size], casting="unsafe")
+        yield i, block
+
+
+def compact_norms(codes, scales):
+    norms = np.empty(len(codes), dtype=np.float32)
+    for i, block in decode_chunks(codes):
+        norms[i:i + len(block)] = np.linalg.norm(block, axis=1)
+    return norms if scales is None else norms * scales
+
+
+def encode_rows(codes, meta, rows, embeddings, encoding):
+    """Encode float32 rows into a compact copy in place, with their scales and norms"""
+    new_codes, scales = encode(embeddings, encoding)
+    codes[rows] = new_codes
+    meta[rows, 0] = 1 if scales is None else scales
+    meta[rows, 1] = compact_norms(new_codes, scales)
+
+
+def compact_distances(query, codes, scales, norms, metric):
+    """Approximate distances from one query to every encoded row"""
+    query = np.asarray(query, dtype=np.float32).reshape(-1)
+    dots = np.empty(len(codes), dtype=np.float32)
+    for i, block in decode_chunks(codes):
+        dots[i:i + len(block)] = block @ query
+    if scales is not None:
+        dots *= scales
+    return distances_from_dots(dots[None, :], np.linalg.norm(query)[None], norms, metric)[0]
+
+
+class FileLock:
+    """Exclusive lock on a file, so several processes can enroll into one gallery"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "a")
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        return False
+
+
+class Gallery:
+    """All enrolled voiceprints in one memory-mapped float32 matrix plus a name index
+
+    Each row is the running centroid of a speaker's enrollment samples. Alongside it
+    stats.npy keeps the sample count and the summed squared distance of the samples
+    to the centroid (Welford's M2), from which spread() is derived.
+
+    Every write first lands in journal.npz as the final rows it will produce, so a write
+    interrupted by a crash is replayed by the next writer rather than applied twice.
+    changes.bin logs the rows of every write, so an index over the gallery can catch up
+    with writes made by any process. Compact int8/float16 copies, once built, are stored
+    next to the matrix and every write re-encodes just the rows it changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file_lock = FileLock(os.path.join(path, LOCK_FILE))
+        self.names = []
+        self.rows = {}
+        self._matrix = None
+        self._stats = None
+        self._norms = None
+        self._compact = {}
+        self._loaded = None
+        self._reload()
+
+    def _reload(self):
+        """Pick up names and matrices written by another process since the last load"""
+        names_file = os.path.join(self.path, NAMES_FILE)
+        if not os.path.exists(names_file):
+            return
+        stat = os.stat(names_file)
+        if self._loaded == (stat.st_mtime_ns, stat.st_size):
+            return
+        with open(names_file) as f:
+            self.names = json.load(f)
+        self.rows = {name: i for i, name in enumerate(self.names)}
+        self._matrix = np.load(os.path.join(self.path, EMBEDDINGS_FILE), mmap_mode='r+')
+        if os.path.exists(os.path.join(self.path, STATS_FILE)):
+            self._stats = np.load(os.path.join(self.path, STATS_FILE), mmap_mode='r+')
+        else:
+            # galleries written before stats existed hold one sample per speaker
+            self._stats = self._new_stats(self._matrix.shape[0])
+        self._norms = None
+        self._compact = {}
+        self._loaded = (stat.st_mtime_ns, stat.st_size)
+
+    def refresh(self):
+        """Reload the gallery if another process has enrolled into it"""
+        with self.lock:
+            self._reload()
+
+    def _new_stats(self, capacity):
+        tmp_file = os.path.join(self.path, STATS_FILE + ".tmp")
+        stats = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float64, shape=(capacity, 2))
+        if self._stats is not None:
+            stats[:len(self.names)] = self._stats[:len(self.names)]
+        else:
+            stats[:len(self.names)] = (1, 0)
+        stats.flush()
+        del stats
+        os.replace(tmp_file, os.path.join(self.path, STATS_FILE))
+        return np.load(os.path.join(self.path, STATS_FILE), mmap_mode='r+')
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def embeddings(self):
+        if self._matrix is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._matrix[:len(self.names)]
+
+    @property
+    def norms(self):
+        if self._norms is None:
+            self._norms = np.linalg.norm(self.embeddings, axis=1)
+        return self._norms
+
+    def compact_files(self, encoding):
+        return (os.path.join(self.path, f"embeddings.{encoding}.npy"),
+                os.path.join(self.path, f"embeddings.{encoding}.meta.npy"))
+
+    def _open_compact(self, encoding):
+        """Memory-map the stored compact copy in encoding, or None if it was never built"""
+        if encoding not in self._compact:
+            codes_file, meta_file = self.compact_files(encoding)
+            if not (os.path.exists(codes_file) and os.path.exists(meta_file)):
+                return None
+            self._compact[encoding] = (np.load(codes_file, mmap_mode='r+'), np.load(meta_file, mmap_mode='r+'))
+        return self._compact[encoding]
+
+    def _build_compact(self, encoding, chunk_size=65536):
+        """Write a compact copy with the matrix's capacity, encoding the enrolled rows a chunk at a time"""
+        if encoding not in COMPACT_DTYPES:
+            raise ValueError(f"Unknown gallery encoding: {encoding}")
+        codes_file, meta_file = self.compact_files(encoding)
+        capacity, dim = self._matrix.shape
+        codes = np.lib.format.open_memmap(codes_file + ".tmp", mode='w+', dtype=COMPACT_DTYPES[encoding], shape=(capacity, dim))
+        meta = np.lib.format.open_memmap(meta_file + ".tmp", mode='w+', dtype=np.float32, shape=(capacity, 2))
+        old = self._open_compact(encoding)
+        if old is not None:
+            # growing: the old copy is already encoded
+            codes[:len(old[0])], meta[:len(old[1])] = old[0], old[1]
+        else:
+            for start in range(0, len(self.names), chunk_size):
+                rows = np.arange(start, min(start + chunk_size, len(self.names)))
+                encode_rows(codes, meta, rows, self._matrix[rows], encoding)
+        codes.flush()
+        meta.flush()
+        del codes, meta
+        os.replace(meta_file + ".tmp", meta_file)
+        os.replace(codes_file + ".tmp", codes_file)
+        self._compact.pop(encoding, None)
+        return self._open_compact(encoding)
+
+    def compact(self, encoding=None):
+        """(encoding, codes, scales, norms) of the stored scan copy in p.GALLERY_ENCODING, built on first use
+
+        Call with self.lock held.
+        """
+        encoding = encoding or p.GALLERY_ENCODING
+        stored = self._open_compact(encoding)
+        if stored is None:
+            with self.file_lock:
+                # another process may have enrolled, or built the copy, while we waited
+                self._reload()
+                stored = self._open_compact(encoding) or self._build_compact(encoding)
+        codes, meta = stored
+        count = len(self.names)
+        return encoding, codes[:count], None if encoding == "float16" else meta[:count, 0], meta[:count, 1]
+
+    def _grow(self, required, dim):
+        # Double the row capacity so appends stay amortised O(1)
+        capacity = MIN_CAPACITY if self._matrix is None else 2 * self._matrix.shape[0]
+        capacity = max(capacity, required)
+        os.makedirs(self.path, exist_ok=True)
+        tmp_file = os.path.join(self.path, EMBEDDINGS_FILE + ".tmp")
+        matrix = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(capacity, dim))
+        if self._matrix is not None:
+            matrix[:len(self.names)] = self.embeddings
+        matrix.flush()
+        del matrix
+        os.replace(tmp_file, os.path.join(self.path, EMBEDDINGS_FILE))
+        self._matrix = np.load(os.path.join(self.path, EMBEDDINGS_FILE), mmap_mode='r+')
+        self._stats = self._new_stats(capacity)
+
+    def _save_names(self):
+        tmp_file = os.path.join(self.path, NAMES_FILE + ".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.names, f)
+        os.replace(tmp_file, os.path.join(self.path, NAMES_FILE))
+        stat = os.stat(os.path.join(self.path, NAMES_FILE))
+        self._loaded = (stat.st_mtime_ns, stat.st_size)
+
+    def _write(self, names, embeddings, update, sources=(), checkpoint=None, export_dir=None):
+        """Apply update(current, embedding) to every name under both locks and persist once
+
+        update gets the name's current (centroid, count, m2), or None for a new name, and
+        returns the new one. If checkpoint is given, sources are appended to it in the same
+        transaction, so they are recorded exactly when their samples are in the gallery.
+        Likewise with export_dir each written centroid is saved there as <name>.npy.
+        """
+        if len(names) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        if export_dir:
+            # refuse names that would write outside export_dir before anything is committed
+            for name in names:
+                check_name(name)
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(names), -1)
+        with self.lock, self.file_lock:
+            self._reload()
+            self._recover()
+            # Work out the final rows in memory and journal them before any memmap is touched
+            state = {}
+            for name, embedding in zip(names, embeddings):
+                current = state.get(name)
+                if current is None and name in self.rows:
+                    row = self.rows[name]
+                    current = (np.asarray(self._matrix[row], dtype=np.float64), *self._stats[row])
+                state[name] = update(current, embedding)
+            journal = {"names": np.array(list(state)),
+                       "centroids": np.array([mean for mean, _, _ in state.values()], dtype=np.float32),
+                       "stats": np.array([(count, m2) for _, count, m2 in state.values()], dtype=np.float64),
+                       "sources": np.array(list(sources), dtype=str), "checkpoint": np.array(checkpoint or ""),
+                       "export_dir": np.array(export_dir or "")}
+            tmp_file = os.path.join(self.path, JOURNAL_FILE + ".tmp")
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                np.savez(f, **journal)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, os.path.join(self.path, JOURNAL_FILE))
+            self._apply(journal)
+            return np.array(self._matrix[[self.rows[name] for name in names]])
+
+    def _apply(self, journal):
+        """Write journaled rows (idempotent: they are absolute values), append its sources and drop the journal"""
+        names = [str(name) for name in journal["names"]]
+        centroids = journal["centroids"]
+        required = len(self.names) + len(set(names) - set(self.rows))
+        if self._matrix is None or required > self._matrix.shape[0]:
+            self._grow(required, centroids.shape[1])
+        # names and rows are replaced, never changed in place, so a reader's view() stays consistent
+        new_names = [name for name in dict.fromkeys(names) if name not in self.rows]
+        rows_by_name = dict(self.rows, **{name: len(self.names) + i for i, name in enumerate(new_names)})
+        rows = [rows_by_name[name] for name in names]
+        self._matrix[rows] = centroids
+        self._stats[rows] = journal["stats"]
+        self._matrix.flush()
+        self._stats.flush()
+        if self._norms is not None:
+            # Only the written rows change, so cached norms are patched rather than recomputed over N rows
+            norms = np.concatenate([self._norms, np.zeros(len(new_names), dtype=self._norms.dtype)]) if new_names else self._norms
+            norms[rows] = np.linalg.norm(centroids, axis=1)
+            self._norms = norms
+        for encoding in COMPACT_DTYPES:
+            stored = self._open_compact(encoding)
+            if stored is None:
+                continue
+            if len(stored[0]) < self._matrix.shape[0]:
+                stored = self._build_compact(encoding)
+            encode_rows(*stored, rows, centroids, encoding)
+            stored[0].flush()
+            stored[1].flush()
+        # logged once the rows are on disk, so a reader of the log always finds them written
+        self._log_changes(rows)
+        self.names, self.rows = self.names + new_names, rows_by_name
+        self._save_names()
+
+        export_dir = str(journal["export_dir"]) if "export_dir" in journal else ""
+        if export_dir:
+            for name, centroid in zip(names, centroids):
+                export_voiceprint(export_dir, name, centroid)
+
+        checkpoint = str(journal["checkpoint"])
+        if checkpoint and len(journal["sources"]):
+            with open(checkpoint, "a") as f:
+                f.write("".join(f"{source}\n" for source in journal["sources"]))
+                f.flush()
+                os.fsync(f.fileno())
+        os.remove(os.path.join(self.path, JOURNAL_FILE))
+        return rows
+
+    def _recover(self):
+        """Replay a journal left by a writer that crashed; returns the replayed (names, centroids)"""
+        journal_file = os.path.join(self.path, JOURNAL_FILE)
+        if not os.path.exists(journal_file):
+            return [], np.zeros((0, 0), dtype=np.float32)
+        with np.load(journal_file) as saved:
+            journal = {key: saved[key] for key in saved.files}
+        rows = self._apply(journal)
+        return [str(name) for name in journal["names"]], np.array(self._matrix[rows])
+
+    def _log_changes(self, rows):
+        changes_file = os.path.join(self.path, CHANGES_FILE)
+        with open(changes_file, "ab") as f:
+            if f.tell() == 0:
+                f.write(os.urandom(CHANGES_HEADER))
+            np.asarray(rows, dtype=np.int32).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def changes(self, since=0):
+        """(log id, rows written since offset since, their centroids, end offset) from changes.bin
+
+        Read under both locks, so the centroids are the ones the logged writes left. An index
+        keeps the id and offset it caught up to; another id, or an end before its offset, means
+        the gallery was deleted and built again.
+        """
+        with self.lock, self.file_lock:
+            self._reload()
+            changes_file = os.path.join(self.path, CHANGES_FILE)
+            if not os.path.exists(changes_file):
+                self._log_changes([])
+            with open(changes_file, "rb") as f:
+                log_id = f.read(CHANGES_HEADER).hex()
+                end = CHANGES_HEADER + (os.fstat(f.fileno()).st_size - CHANGES_HEADER) // 4 * 4
+                f.seek(min(max(since, CHANGES_HEADER), end))
+                rows = np.frombuffer(f.read(end - f.tell()), dtype=np.int32)
+            rows = np.unique(rows).astype(np.int64)
+            centroids = np.array(self._matrix[rows]) if len(rows) else np.zeros((0, 0), dtype=np.float32)
+            return log_id, rows, centroids, end
+
+    def recover(self):
+        """Finish a write interrupted by a crash, returning the (names, centroids) it wrote"""
+        with self.lock, self.file_lock:
+            self._reload()
+            return self._recover()
+
+    def add(self, name, embedding):
+        """Store or overwrite the voiceprint of one speaker"""
+        self.add_many([name], [embedding])
+
+    def add_many(self, names, embeddings):
+        """Store or overwrite several voiceprints with a single index write"""
+        def overwrite(current, embedding):
+            return embedding, 1, 0.0
+        self._write(names, embeddings, overwrite)
+
+    def add_sample(self, name, embedding, export_dir=None):
+        """Fold one more enrollment sample into a speaker's voiceprint, returning the new centroid"""
+        return self.add_samples([name], [embedding], export_dir=export_dir)[0]
+
+    def add_samples(self, names, embeddings, sources=(), checkpoint=None, export_dir=None):
+        """Fold enrollment samples into their speakers' centroids, O(1) per sample, returning the centroids
+
+        sources, if given, are appended to the checkpoint file in the same transaction, and
+        with export_dir the new centroids are saved there as .npy files in it too.
+        """
+        def accumulate(current, embedding):
+            if current is None:
+                return embedding.astype(np.float64), 1, 0.0
+            mean, count, m2 = current
+            delta = embedding - mean
+            count += 1
+            mean = mean + delta / count
+            m2 += float(delta @ (embedding - mean))
+            return mean, count, m2
+        return self._write(names, embeddings, accumulate, sources, checkpoint, export_dir)
+
+    def samples(self, name):
+        """Number of enrollment samples behind a speaker's voiceprint"""
+        return int(self._stats[self.rows[name], 0])
+
+    def spread(self, name):
+        """Root-mean-square Euclidean distance of a speaker's samples to their centroid"""
+        count, m2 = self._stats[self.rows[name]]
+        return float(np.sqrt(m2 / count))
+
+    def view(self):
+        """(names, embeddings, norms) of one consistent state, safe to read while another thread writes"""
+        with self.lock:
+            self._reload()
+            return self.names, self.embeddings, self.norms
+
+    def scores(self, embedding, metric=None):
+        """Distance from one embedding to every enrolled speaker"""
+        _, embeddings, norms = self.view()
+        return distances(embedding, embeddings, metric or p.COST_METRIC, norms)[0]
+
+    def rerank(self, embedding, metric=None, k=None, encoding=None):
+        """Scan the compact copy, then rescore its top k rows exactly in float32, best first"""
+        metric = metric or p.COST_METRIC
+        with self.lock:
+            self._reload()
+            (_, codes, scales, norms), embeddings = self.compact(encoding), self.embeddings
+        approx = compact_distances(embedding, codes, scales, norms, metric)
+        k = min(k or p.RERANK_TOP_K, len(approx))
+        rows = np.sort(np.argpartition(approx, k - 1)[:k])
+        exact = distances(embedding, embeddings[rows], metric)[0]
+        order = np.argsort(exact)
+        return rows[order], exact[order]
+
+    def verify(self, name, embedding, metric=None):
+        """Distance from one embedding to the claimed speaker only, or None if they are not enrolled"""
+        with self.lock:
+            self._reload()
+            row, embeddings = self.rows.get(name), self.embeddings
+        if row is None:
+            return None
+        with metrics.timer("scoring"):
+            score = float(distances(embedding, embeddings[row:row + 1], metric or p.COST_METRIC)[0, 0])
+        metrics.observe(metrics.scores, score)
+        return score
+
+    def identify(self, embedding, metric=None):
+        """Return the closest enrolled speaker and its distance, or (None, None) if empty"""
+        names, embeddings, norms = self.view()
+        if len(names) == 0:
+            return None, None
+        # rows only ever get appended, so rows found by any later scan are still valid in names
+        with metrics.timer("scoring"):
+            rows = None
+            if p.USE_ANN_INDEX and len(names) >= p.ANN_MIN_GALLERY:
+                from ann_index import get_index
+                rows, scores = get_index(self).search(embedding, metric=metric)
+            elif p.GALLERY_ENCODING != "float32":
+                rows, scores = self.rerank(embedding, metric)
+            if rows is not None and len(rows):
+                name, score = self.names[rows[0]], float(scores[0])
+            else:
+                # the exact scan, also when the probed ANN lists held no candidates
+                scores = distances(embedding, embeddings, metric or p.COST_METRIC, norms)[0]
+                best = int(np.argmin(scores))
+                name, score = names[best], float(scores[best])
+        metrics.observe(metrics.gallery_scanned, len(names))
+        metrics.observe(metrics.scores, score)
+        return name, score
+
+    def top_k(self, embeddings, k=None, metric=None):
+        """The k closest speakers to each row of a probe block as (rows, distances), best first
+
+        The whole block is scored against the whole gallery in one matrix product.
+        """
+        _, gallery_embeddings, norms = self.view()
+        with metrics.timer("scoring"):
+            scores = distances(embeddings, gallery_embeddings, metric or p.COST_METRIC, norms)
+            k = min(k or p.RECOGNIZE_TOP_K, scores.shape[1])
+            rows = np.argpartition(scores, k - 1, axis=1)[:, :k]
+            top = np.take_along_axis(scores, rows, axis=1)
+            order = np.argsort(top, axis=1)
+        return np.take_along_axis(rows, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+
+def import_embed_dir(embed_dir, path):
+    """Build a gallery at path from a directory of per-speaker .npy files"""
+    gallery = Gallery(path)
+    files = sorted(emb for emb in os.listdir(embed_dir) if emb.endswith(".npy"))
+    if files:
+        gallery.add_many([emb.replace(".npy", "") for emb in files],
+                         [np.load(os.path.join(embed_dir, emb)).flatten() for emb in files])
+    return gallery
+
+
+_gallery = None
+_gallery_lock = threading.Lock()
+
+
+def get_gallery():
+    """Return the process-wide gallery, importing data/embed on first use"""
+    global _gallery
+    with _gallery_lock:
+        if _gallery is None or _gallery.path != p.GALLERY_DIR:
+            if not os.path.exists(os.path.join(p.GALLERY_DIR, NAMES_FILE)) and os.path.exists(p.EMBED_LIST_FILE):
+                print("Importing voiceprints from [{}] into [{}]....".format(p.EMBED_LIST_FILE, p.GALLERY_DIR))
+                _gallery = import_embed_dir(p.EMBED_LIST_FILE, p.GALLERY_DIR)
+            else:
+                _gallery = Gallery(p.GALLERY_DIR)
+        return _gallery
+
+
+if __name__ == '__main__':
+    gallery = import_embed_dir(p.EMBED_LIST_FILE, p.GALLERY_DIR)
+    print("Imported {} voiceprints into [{}]".format(len(gallery), p.GALLERY_DIR))
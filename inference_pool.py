@@ -0,0 +1,266 @@
+import logging
+import multiprocessing
+import os
+import queue
+import traceback
+import warnings
+from multiprocessing import shared_memory
+import numpy as np
+
+from feature_extraction import buckets
+from preprocess import fft_spectrum, load
+import parameters as p
+
+# Environment for front-end processes: NumPy and SciPy stay on the one CPU each process is pinned to
+SINGLE_THREAD_ENV = {"OMP_NUM_THREADS": "1", "OPENBLAS_NUM_THREADS": "1", "MKL_NUM_THREADS": "1"}
+
+
+class SpectrumRing:
+    """Spectrogram slots in shared memory, (slots, NUM_FFT, width) float32, handed between processes by index
+
+    Only slot numbers travel through queues; the spectra themselves are written in place by
+    the front-end process and read in place by the inference process, never pickled.
+    """
+
+    def __init__(self, slots, width, name=None):
+        self.slots = slots
+        self.width = width
+        size = slots * p.NUM_FFT * width * np.dtype(np.float32).itemsize
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.array = np.ndarray((slots, p.NUM_FFT, width), dtype=np.float32, buffer=self.shm.buf)
+
+    def info(self):
+        """Arguments that let another process attach to the same memory"""
+        return self.slots, self.width, self.shm.name
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def available_cpus():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+def pool_fits(inference_workers=None, intra_threads=None):
+    """Whether the CPUs hold the inference workers' threads plus at least one front-end process"""
+    inference_workers = inference_workers or p.POOL_INFERENCE_WORKERS
+    intra_threads = intra_threads or p.POOL_INTRA_OP_THREADS
+    return available_cpus() > inference_workers * intra_threads
+
+
+def cpu_layout(inference_workers, intra_threads, dsp_workers):
+    """CPUs for each inference worker (intra_threads apiece) and each front-end worker (one apiece)
+
+    CPUs are handed out in order and wrap around when there are fewer than workers need.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    inference = [{cpus[(i * intra_threads + j) % len(cpus)] for j in range(intra_threads)}
+                 for i in range(inference_workers)]
+    first = inference_workers * intra_threads
+    dsp = [{cpus[(first + i) % len(cpus)]} for i in range(dsp_workers)]
+    return inference, dsp
+
+
+def spectrum_worker(filename, buckets_var):
+    """Decode one file and compute its spectrum, run inside a front-end process"""
+    return fft_spectrum(load(filename, p.SAMPLE_RATE), buckets_var)
+
+
+def setup_worker(settings, cpus):
+    """Bring a spawned process's parameters in line with the parent's and pin it to its CPUs"""
+    vars(p).update(settings)
+    logging.getLogger('tensorflow').setLevel(logging.FATAL)
+    warnings.filterwarnings("ignore")
+    if p.POOL_PIN_CPUS and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+
+
+def dsp_worker(settings, cpus, ring_info, tasks, free, ready, results):
+    """Decode files and write their spectra into free ring slots until a None task arrives"""
+    setup_worker(settings, cpus)
+    ring = SpectrumRing(*ring_info)
+    buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+    for job, filename in iter(tasks.get, None):
+        try:
+            spectrum = spectrum_worker(filename, buckets_var)
+        except Exception as e:
+            results.put((job, None, str(e)))
+            continue
+        slot = free.get()
+        ring.array[slot, :, :spectrum.shape[1]] = spectrum
+        ready.put((job, slot, spectrum.shape[1]))
+    ring.close()
+
+
+def inference_worker(settings, cpus, ring_info, ready, free, results):
+    """Embed whatever spectra are ready, one model call per width, until a None item arrives"""
+    setup_worker(settings, cpus)
+    # thread counts only take effect if they are set before the model runs anything
+    if p.MODEL_BACKEND == "tensorflow":
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(p.POOL_INTRA_OP_THREADS)
+        tf.config.threading.set_inter_op_parallelism_threads(p.POOL_INTER_OP_THREADS)
+    else:
+        p.TFLITE_THREADS = p.POOL_INTRA_OP_THREADS
+    try:
+        from model import get_model
+
+        model = get_model()
+        ring = SpectrumRing(*ring_info)
+    except Exception:
+        # the parent re-raises this, rather than only seeing an exit code
+        results.put((None, None, traceback.format_exc()))
+        return
+    results.put((None, None, None))
+    running = True
+    while running:
+        items = [ready.get()]
+        # Batch up everything already waiting, so a busy pool sends full batches to the model
+        while len(items) < p.BATCH_SIZE:
+            try:
+                items.append(ready.get_nowait())
+            except queue.Empty:
+                break
+        if None in items:
+            running = False
+            # the one stop item is passed on, so every inference worker sees it
+            ready.put(None)
+
+        groups = {}
+        for job, slot, width in (item for item in items if item is not None):
+            groups.setdefault(width, []).append((job, slot))
+        for width, group in groups.items():
+            batch = np.empty((len(group), p.NUM_FFT, width, 1), dtype=np.float32)
+            for i, (_, slot) in enumerate(group):
+                batch[i, :, :, 0] = ring.array[slot, :, :width]
+                free.put(slot)
+            try:
+                embeddings = model.predict(batch)
+            except Exception as e:
+                for job, _ in group:
+                    results.put((job, None, str(e)))
+                continue
+            for (job, _), embedding in zip(group, embeddings):
+                results.put((job, embedding, None))
+    ring.close()
+
+
+class InferencePool:
+    """Front-end DSP processes feeding inference processes through a shared-memory spectrogram ring
+
+    Each front-end process decodes and transforms one file at a time on its own CPU; each
+    inference process holds the model with explicit TensorFlow thread counts on its own
+    CPUs. Only file names, slot numbers and the (small) embeddings are pickled.
+    """
+
+    def __init__(self, dsp_workers=None, inference_workers=None, intra_threads=None, inter_threads=None):
+        inference_workers = inference_workers or p.POOL_INFERENCE_WORKERS
+        intra_threads = intra_threads or p.POOL_INTRA_OP_THREADS
+        dsp_workers = dsp_workers or p.NUM_WORKERS or max(1, available_cpus() - inference_workers * intra_threads)
+        settings = {name: value for name, value in vars(p).items() if name.isupper()}
+        settings.update(POOL_INTRA_OP_THREADS=intra_threads, POOL_INTER_OP_THREADS=inter_threads or p.POOL_INTER_OP_THREADS)
+
+        # spawn rather than fork, since the parent may already run TensorFlow threads
+        context = multiprocessing.get_context("spawn")
+        slots = dsp_workers * p.POOL_SLOTS_PER_WORKER
+        self.ring = SpectrumRing(slots, max(buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)))
+        self.tasks = context.Queue()
+        self.free = context.Queue()
+        self.ready = context.Queue()
+        self.results = context.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.max_pending = 2 * slots
+        self.inference, self.dsp = [], []
+        try:
+            self._start(context, settings, inference_workers, intra_threads, dsp_workers)
+        except BaseException:
+            self.terminate()
+            raise
+
+    def _start(self, context, settings, inference_workers, intra_threads, dsp_workers):
+        inference_cpus, dsp_cpus = cpu_layout(inference_workers, intra_threads, dsp_workers)
+        self.inference = [context.Process(target=inference_worker, daemon=True,
+                                          args=(settings, cpus, self.ring.info(), self.ready, self.free, self.results))
+                          for cpus in inference_cpus]
+        self.dsp = [context.Process(target=dsp_worker, daemon=True,
+                                    args=(settings, cpus, self.ring.info(), self.tasks, self.free, self.ready, self.results))
+                    for cpus in dsp_cpus]
+        for process in self.inference:
+            process.start()
+        saved = {name: os.environ.get(name) for name in SINGLE_THREAD_ENV}
+        os.environ.update(SINGLE_THREAD_ENV)
+        try:
+            for process in self.dsp:
+                process.start()
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+        # Wait until every inference worker has loaded its model, so map() timings exclude start-up
+        for _ in self.inference:
+            _, _, error = self._get()
+            if error is not None:
+                raise RuntimeError("Inference pool worker failed to start:\n" + error)
+
+    def _get(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                dead = [process for process in self.inference + self.dsp if not process.is_alive()]
+                if dead:
+                    raise RuntimeError("Inference pool worker exited with code {}".format(dead[0].exitcode))
+
+    def map(self, rows):
+        """Yield (row, embedding, error) for rows whose first field is a filename, in completion order
+
+        embedding is None, and error the message, for files that could not be embedded.
+        """
+        pending = {}
+        for job, row in enumerate(rows):
+            # Bound the files queued ahead of the workers so memory does not grow with the list
+            while len(pending) >= self.max_pending:
+                done, embedding, error = self._get()
+                yield pending.pop(done), embedding, error
+            self.tasks.put((job, row[0]))
+            pending[job] = row
+        while pending:
+            done, embedding, error = self._get()
+            yield pending.pop(done), embedding, error
+
+    def close(self):
+        for _ in self.dsp:
+            self.tasks.put(None)
+        for process in self.dsp:
+            process.join()
+        # inference only stops once every front-end process has handed over its last spectrum
+        self.ready.put(None)
+        for process in self.inference:
+            process.join()
+        self.ring.close()
+
+    def terminate(self):
+        """Stop every started worker without waiting for its queue, and free the ring"""
+        for process in self.dsp + self.inference:
+            if process.pid is not None:
+                process.terminate()
+                process.join()
+        self.ring.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # workers may be blocked on a slot or a dead peer, so they are not waited for
+            self.terminate()
+        return False
@@ -1,16 +1,113 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from voice_auth import enroll, recognize
+from voice_auth import save_voiceprint, score_spectrum
 import parameters as p
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from preprocess import get_fft_spectrum
-from feature_extraction import buckets
+from preprocess import get_fft_spectrum, StreamingSpectrum
+from feature_extraction import buckets, get_embedding
+from gallery import get_gallery
+from model import get_model
 import sounddevice as sd
-import soundfile as sf
 import numpy as np
-from datetime import datetime
+import time
+
+# Progress bar value shown when each pipeline stage starts
+STAGE_PROGRESS = {"model": 10, "decode": 25, "features": 45, "inference": 70, "scoring": 90, "saving": 90}
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self):
+        self.cancel_event = threading.Event()
+    
+    def cancel(self):
+        self.cancel_event.set()
+
+class BackgroundJobs:
+    """Runs model loading, decoding, FFT and inference off the Tk main thread
+    
+    Workers never touch widgets: progress, results and errors are queued and
+    delivered on the main thread by an after() poll.
+    """
+    POLL_MS = 50
+    
+    def __init__(self, root, workers=2):
+        self.root = root
+        self.executor = ThreadPoolExecutor(workers)
+        self.events = queue.Queue()
+        self.active = set()
+        self.root.after(self.POLL_MS, self.poll)
+    
+    def submit(self, work, on_done=None, on_progress=None, on_error=None):
+        """Run work(progress) in the background; progress(stage) raises JobCancelled once cancelled"""
+        job = Job()
+        
+        def progress(stage):
+            if job.cancel_event.is_set():
+                raise JobCancelled()
+            if on_progress:
+                self.events.put((on_progress, (stage,)))
+        
+        def run():
+            try:
+                result = work(progress)
+                if on_done:
+                    self.events.put((on_done, (result,)))
+            except Exception as e:
+                if on_error:
+                    self.events.put((on_error, (e,)))
+            finally:
+                self.events.put((self.active.discard, (job,)))
+        
+        self.active.add(job)
+        self.executor.submit(run)
+        return job
+    
+    def cancel_all(self):
+        for job in list(self.active):
+            job.cancel()
+    
+    def poll(self):
+        # reschedule first so a failing callback cannot stop delivery
+        self.root.after(self.POLL_MS, self.poll)
+        while True:
+            try:
+                callback, args = self.events.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+
+def is_enrolled(username):
+    """Whether username has a voiceprint in the gallery, which signup and login both go by"""
+    gallery = get_gallery()
+    gallery.refresh()
+    return username in gallery.rows
+
+def draw_spectrogram(spectrogram, target_frame):
+    for widget in target_frame.winfo_children():
+        widget.destroy()
+    
+    fig = plt.Figure(figsize=(5, 1.5), dpi=100)
+    ax = fig.add_subplot(111)
+    cax = ax.imshow(spectrogram, aspect='auto', origin='lower')
+    fig.colorbar(cax, ax=ax)
+    ax.set_title("Spectrogram")
+    ax.axis('off')
+    
+    canvas = FigureCanvasTkAgg(fig, master=target_frame)
+    canvas.draw()
+    canvas.get_tk_widget().pack(fill="both", expand=True)
+
+def compute_spectrogram(audio, sample_rate=None):
+    """Background job body for a spectrogram preview"""
+    buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+    return lambda progress: get_fft_spectrum(audio, buckets_var, sample_rate, progress)
 
 class VoiceAuthApp:
     def __init__(self, root):
@@ -28,6 +125,9 @@ class VoiceAuthApp:
                       foreground=[('active', 'white'), ('!active', 'white')],
                       background=[('active', '#3498db'), ('!active', '#2980b9')])
         
+        # Shared worker threads, all jobs use the same resident model
+        self.jobs = BackgroundJobs(root)
+        
         # Create container frame
         self.container = tk.Frame(root, bg="#f0f2f5")
         self.container.pack(fill="both", expand=True)
@@ -53,6 +153,7 @@ class VoiceLoginPage(tk.Frame):
         tk.Frame.__init__(self, parent, bg="#f0f2f5")
         self.controller = controller
         self.recording = False
+        self.stop_timer = None
         self.frames = []
         
         # Header
@@ -93,13 +194,20 @@ class VoiceLoginPage(tk.Frame):
         # Audio Config
         self.sample_rate = 16000
         self.duration = 3  # seconds
-        self.audio_file = "temp_login.wav"
+        self.audio_data = None
+        self.early_result = None
+        self.scoring = False
     
     def toggle_recording(self):
         if not self.recording:
             self.recording = True
             self.voice_login_btn.config(text="Recording... (3s)")
             self.frames = []
+            self.stream = StreamingSpectrum()
+            self.fed_chunks = 0
+            self.early_result = None
+            self.scoring = False
+            self.record_start = time.perf_counter()
             
             # Start recording
             self.recording_stream = sd.InputStream(
@@ -109,48 +217,71 @@ class VoiceLoginPage(tk.Frame):
             )
             self.recording_stream.start()
             
-            # Stop after duration
-            self.root.after(self.duration * 1000, self.stop_recording)
+            # Stop after duration, or earlier once the stream gives a confident decision
+            self.stop_timer = self.after(self.duration * 1000, self.stop_recording)
+            self.after(p.STREAM_POLL_MS, self.poll_stream)
         else:
             self.stop_recording()
     
     def audio_callback(self, indata, frames, time, status):
         self.frames.append(indata.copy())
     
+    def poll_stream(self):
+        if not self.recording:
+            return
+        
+        # Feed the chunks captured since the last poll
+        chunks = self.frames[self.fed_chunks:]
+        self.fed_chunks += len(chunks)
+        for chunk in chunks:
+            self.stream.feed(chunk)
+        
+        # Score the claimed user in the background once the smallest bucket worth of voiced frames is in
+        buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+        username = self.username_entry.get()
+        if (self.stream.voiced_frames >= min(buckets_var) and not self.scoring
+                and is_enrolled(username)):
+            self.scoring = True
+            spectrum = self.stream.spectrum(buckets_var)
+            self.controller.jobs.submit(lambda progress: score_spectrum(spectrum, username),
+                                        on_done=self.early_decision,
+                                        on_error=lambda e: setattr(self, "scoring", False))
+        self.after(p.STREAM_POLL_MS, self.poll_stream)
+    
+    def early_decision(self, result):
+        self.scoring = False
+        speaker, distance = result
+        if (not self.recording or distance is None or speaker != self.username_entry.get()
+                or distance >= p.THRESHOLD - p.EARLY_DECISION_MARGIN):
+            return
+        self.early_result = result
+        elapsed = time.perf_counter() - self.record_start
+        self.stop_recording()
+        self.status_label.config(text=f"Voice recognized after {elapsed:.1f}s", fg="#2ecc71")
+        self.login()
+    
     def stop_recording(self):
+        # a recording stopped early must not leave its timer to cut the next one short
+        if self.stop_timer is not None:
+            self.after_cancel(self.stop_timer)
+            self.stop_timer = None
         if self.recording:
             self.recording = False
             self.voice_login_btn.config(text="Record Voice")
             self.recording_stream.stop()
             
-            # Save recording
-            audio_data = np.concatenate(self.frames)
-            sf.write(self.audio_file, audio_data, self.sample_rate)
+            # Keep the recording in memory, it is already mono at self.sample_rate
+            self.audio_data = np.concatenate(self.frames)[:, 0]
             
             # Show spectrogram
-            self.show_spectrogram(self.audio_file)
+            self.show_spectrogram(self.audio_data)
             self.status_label.config(text="Voice sample recorded", fg="#2ecc71")
     
-    def show_spectrogram(self, filepath):
-        for widget in self.spectrogram_frame.winfo_children():
-            widget.destroy()
-        
-        try:
-            buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
-            spectrogram = get_fft_spectrum(filepath, buckets_var)
-            
-            fig = plt.Figure(figsize=(5, 1.5), dpi=100)
-            ax = fig.add_subplot(111)
-            cax = ax.imshow(spectrogram, aspect='auto', origin='lower')
-            fig.colorbar(cax, ax=ax)
-            ax.set_title("Spectrogram")
-            ax.axis('off')
-            
-            canvas = FigureCanvasTkAgg(fig, master=self.spectrogram_frame)
-            canvas.draw()
-            canvas.get_tk_widget().pack(fill="both", expand=True)
-        except Exception as e:
-            self.status_label.config(text=f"Spectrogram error: {str(e)}", fg="#e74c3c")
+    def show_spectrogram(self, audio_data):
+        self.controller.jobs.submit(
+            compute_spectrogram(audio_data, self.sample_rate),
+            on_done=lambda spectrogram: draw_spectrogram(spectrogram, self.spectrogram_frame),
+            on_error=lambda e: self.status_label.config(text=f"Spectrogram error: {str(e)}", fg="#e74c3c"))
     
     def login(self):
         username = self.username_entry.get()
@@ -159,28 +290,48 @@ class VoiceLoginPage(tk.Frame):
             self.status_label.config(text="Username required", fg="#e74c3c")
             return
         
-        if not os.path.exists(self.audio_file):
+        if self.audio_data is None:
             self.status_label.config(text="Please record voice sample", fg="#e74c3c")
             return
         
         try:
             # Check if user exists
-            user_file = os.path.join(p.EMBED_LIST_FILE, f"{username}.npy")
-            if not os.path.exists(user_file):
+            if not is_enrolled(username):
                 self.status_label.config(text="User not found", fg="#e74c3c")
                 return
             
-            # Verify voice
-            recognize(self.audio_file)
-            self.controller.show_page("MainPage")
+            # Verify voice, reusing the decision made while recording if it was for this user
+            if self.early_result is not None and self.early_result[0] == username:
+                self.login_done(self.early_result)
+                return
+            audio_data = self.audio_data
+            
+            def work(progress):
+                progress("model")
+                model = get_model()
+                embedding = get_embedding(model, audio_data, p.MAX_SEC, self.sample_rate, progress)
+                progress("scoring")
+                return username, get_gallery().verify(username, embedding)
+            
+            self.status_label.config(text="Checking voice...", fg="#2c3e50")
+            self.controller.jobs.submit(work, on_done=self.login_done,
+                on_error=lambda e: self.status_label.config(text=f"Login failed: {str(e)}", fg="#e74c3c"))
         except Exception as e:
             self.status_label.config(text=f"Login failed: {str(e)}", fg="#e74c3c")
+    
+    def login_done(self, result):
+        username, distance = result
+        if distance is None or distance >= p.THRESHOLD:
+            self.status_label.config(text="Voice does not match, please try again", fg="#e74c3c")
+            return
+        self.controller.show_page("MainPage")
 
 class VoiceSignupPage(tk.Frame):
     def __init__(self, parent, controller):
         tk.Frame.__init__(self, parent, bg="#f0f2f5")
         self.controller = controller
         self.recording = False
+        self.stop_timer = None
         self.frames = []
         
         # Header
@@ -221,7 +372,7 @@ class VoiceSignupPage(tk.Frame):
         # Audio Config
         self.sample_rate = 16000
         self.duration = 5  # seconds for enrollment
-        self.audio_file = "temp_signup.wav"
+        self.audio_data = None
     
     def toggle_recording(self):
         if not self.recording:
@@ -238,7 +389,7 @@ class VoiceSignupPage(tk.Frame):
             self.recording_stream.start()
             
             # Stop after duration
-            self.root.after(self.duration * 1000, self.stop_recording)
+            self.stop_timer = self.after(self.duration * 1000, self.stop_recording)
         else:
             self.stop_recording()
     
@@ -246,39 +397,27 @@ class VoiceSignupPage(tk.Frame):
         self.frames.append(indata.copy())
     
     def stop_recording(self):
+        # a recording stopped early must not leave its timer to cut the next one short
+        if self.stop_timer is not None:
+            self.after_cancel(self.stop_timer)
+            self.stop_timer = None
         if self.recording:
             self.recording = False
             self.voice_record_btn.config(text="Record Voice")
             self.recording_stream.stop()
             
-            # Save recording
-            audio_data = np.concatenate(self.frames)
-            sf.write(self.audio_file, audio_data, self.sample_rate)
+            # Keep the recording in memory, it is already mono at self.sample_rate
+            self.audio_data = np.concatenate(self.frames)[:, 0]
             
             # Show spectrogram
-            self.show_spectrogram(self.audio_file)
+            self.show_spectrogram(self.audio_data)
             self.status_label.config(text="Voice sample recorded", fg="#2ecc71")
     
-    def show_spectrogram(self, filepath):
-        for widget in self.spectrogram_frame.winfo_children():
-            widget.destroy()
-        
-        try:
-            buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
-            spectrogram = get_fft_spectrum(filepath, buckets_var)
-            
-            fig = plt.Figure(figsize=(5, 1.5), dpi=100)
-            ax = fig.add_subplot(111)
-            cax = ax.imshow(spectrogram, aspect='auto', origin='lower')
-            fig.colorbar(cax, ax=ax)
-            ax.set_title("Spectrogram")
-            ax.axis('off')
-            
-            canvas = FigureCanvasTkAgg(fig, master=self.spectrogram_frame)
-            canvas.draw()
-            canvas.get_tk_widget().pack(fill="both", expand=True)
-        except Exception as e:
-            self.status_label.config(text=f"Spectrogram error: {str(e)}", fg="#e74c3c")
+    def show_spectrogram(self, audio_data):
+        self.controller.jobs.submit(
+            compute_spectrogram(audio_data, self.sample_rate),
+            on_done=lambda spectrogram: draw_spectrogram(spectrogram, self.spectrogram_frame),
+            on_error=lambda e: self.status_label.config(text=f"Spectrogram error: {str(e)}", fg="#e74c3c"))
     
     def signup(self):
         username = self.username_entry.get()
@@ -287,37 +426,45 @@ class VoiceSignupPage(tk.Frame):
             self.status_label.config(text="Username required", fg="#e74c3c")
             return
         
-        if not os.path.exists(self.audio_file):
+        if self.audio_data is None:
             self.status_label.config(text="Please record voice sample", fg="#e74c3c")
             return
         
         try:
-            # Create embeddings directory if not exists
-            os.makedirs(p.EMBED_LIST_FILE, exist_ok=True)
-            
             # Check if user already exists
-            user_file = os.path.join(p.EMBED_LIST_FILE, f"{username}.npy")
-            if os.path.exists(user_file):
+            if is_enrolled(username):
                 self.status_label.config(text="Username already exists", fg="#e74c3c")
                 return
             
             # Enroll user
-            enroll(username, self.audio_file)
-            self.status_label.config(text="Signup successful! Please login", fg="#2ecc71")
-            
-            # Clear fields
-            self.username_entry.delete(0, tk.END)
-            for widget in self.spectrogram_frame.winfo_children():
-                widget.destroy()
+            audio_data = self.audio_data
             
-            # Delete temp file
-            if os.path.exists(self.audio_file):
-                os.remove(self.audio_file)
+            def work(progress):
+                progress("model")
+                model = get_model()
+                embedding = get_embedding(model, audio_data, p.MAX_SEC, self.sample_rate, progress)
+                progress("saving")
+                save_voiceprint(username, embedding)
             
-            # Go to login page
-            self.controller.show_page("VoiceLoginPage")
+            self.status_label.config(text="Enrolling...", fg="#2c3e50")
+            self.controller.jobs.submit(work, on_done=self.signup_done,
+                on_error=lambda e: self.status_label.config(text=f"Signup failed: {str(e)}", fg="#e74c3c"))
         except Exception as e:
             self.status_label.config(text=f"Signup failed: {str(e)}", fg="#e74c3c")
+    
+    def signup_done(self, result):
+        self.status_label.config(text="Signup successful! Please login", fg="#2ecc71")
+        
+        # Clear fields
+        self.username_entry.delete(0, tk.END)
+        for widget in self.spectrogram_frame.winfo_children():
+            widget.destroy()
+        
+        # Drop the recording
+        self.audio_data = None
+        
+        # Go to login page
+        self.controller.show_page("VoiceLoginPage")
 
 class MainPage(tk.Frame):
     def __init__(self, parent, controller):
@@ -405,6 +552,8 @@ class MainPage(tk.Frame):
         self.progress = ttk.Progressbar(console_frame, mode="determinate")
         self.progress.pack(fill="x", padx=5, pady=(0,5))
         
+        tk.Button(console_frame, text="Cancel", command=self.cancel_jobs).pack(pady=(0,5))
+        
         # Initialize variables
         self.enroll_file = None
         self.recognize_file = None
@@ -414,10 +563,10 @@ class MainPage(tk.Frame):
     
     def refresh_enrolled_users(self):
         self.users_listbox.delete(0, tk.END)
-        if os.path.exists(p.EMBED_LIST_FILE):
-            for file in os.listdir(p.EMBED_LIST_FILE):
-                if file.endswith(".npy"):
-                    self.users_listbox.insert(tk.END, file[:-4])
+        gallery = get_gallery()
+        gallery.refresh()
+        for name in gallery.names:
+            self.users_listbox.insert(tk.END, name)
     
     def log_message(self, message):
         self.console.config(state="normal")
@@ -425,26 +574,27 @@ class MainPage(tk.Frame):
         self.console.see("end")
         self.console.config(state="disabled")
     
+    def show_stage(self, stage):
+        if stage in STAGE_PROGRESS:
+            self.progress["value"] = STAGE_PROGRESS[stage]
+            self.log_message(f"  {stage}...")
+    
+    def job_failed(self, task, error):
+        self.progress["value"] = 0
+        if isinstance(error, JobCancelled):
+            self.log_message(f"{task} cancelled")
+            return
+        self.log_message(f"{task} failed: {str(error)}")
+        messagebox.showerror("Error", f"{task} failed: {str(error)}")
+    
+    def cancel_jobs(self):
+        self.controller.jobs.cancel_all()
+    
     def show_spectrogram(self, filepath, target_frame):
-        for widget in target_frame.winfo_children():
-            widget.destroy()
-        
-        try:
-            buckets_var = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
-            spectrogram = get_fft_spectrum(filepath, buckets_var)
-            
-            fig = plt.Figure(figsize=(5, 1.5), dpi=100)
-            ax = fig.add_subplot(111)
-            cax = ax.imshow(spectrogram, aspect='auto', origin='lower')
-            fig.colorbar(cax, ax=ax)
-            ax.set_title("Spectrogram")
-            ax.axis('off')
-            
-            canvas = FigureCanvasTkAgg(fig, master=target_frame)
-            canvas.draw()
-            canvas.get_tk_widget().pack(fill="both", expand=True)
-        except Exception as e:
-            self.log_message(f"Spectrogram error: {str(e)}")
+        self.controller.jobs.submit(
+            compute_spectrogram(filepath),
+            on_done=lambda spectrogram: draw_spectrogram(spectrogram, target_frame),
+            on_error=lambda e: self.log_message(f"Spectrogram error: {str(e)}"))
     
     def select_enroll_file(self):
         filepath = filedialog.askopenfilename(filetypes=[("Audio Files", "*.wav *.flac")])
@@ -463,7 +613,7 @@ class MainPage(tk.Frame):
             self.log_message(f"Selected recognition file: {filepath}")
     
     def enroll_user(self):
-        if not hasattr(self, 'enroll_file'):
+        if not self.enroll_file:
             messagebox.showerror("Error", "Please select an audio file first")
             return
         
@@ -472,41 +622,56 @@ class MainPage(tk.Frame):
             messagebox.showerror("Error", "Please enter a name")
             return
         
-        self.progress["value"] = 30
-        self.root.update()
-        
+        self.progress["value"] = 0
         self.log_message(f"Enrolling user: {name}")
-        try:
-            enroll(name, self.enroll_file)
-            self.progress["value"] = 100
-            self.log_message("Enrollment successful!")
-            self.refresh_enrolled_users()
-            self.name_entry.delete(0, tk.END)
-            self.enroll_file_label.config(text="No file selected")
-            for widget in self.enroll_spectrogram_frame.winfo_children():
-                widget.destroy()
-            del self.enroll_file
-        except Exception as e:
-            self.progress["value"] = 0
-            self.log_message(f"Enrollment failed: {str(e)}")
-            messagebox.showerror("Error", f"Enrollment failed: {str(e)}")
+        enroll_file = self.enroll_file
+        
+        def work(progress):
+            progress("model")
+            model = get_model()
+            embedding = get_embedding(model, enroll_file, p.MAX_SEC, progress=progress)
+            progress("saving")
+            save_voiceprint(name, embedding)
+        
+        self.controller.jobs.submit(work, on_done=self.enroll_done, on_progress=self.show_stage,
+                                    on_error=lambda e: self.job_failed("Enrollment", e))
+    
+    def enroll_done(self, result):
+        self.progress["value"] = 100
+        self.log_message("Enrollment successful!")
+        self.refresh_enrolled_users()
+        self.name_entry.delete(0, tk.END)
+        self.enroll_file_label.config(text="No file selected")
+        for widget in self.enroll_spectrogram_frame.winfo_children():
+            widget.destroy()
+        self.enroll_file = None
     
     def recognize_user(self):
-        if not hasattr(self, 'recognize_file'):
+        if not self.recognize_file:
             messagebox.showerror("Error", "Please select an audio file first")
             return
         
-        self.progress["value"] = 30
-        self.root.update()
-        
+        self.progress["value"] = 0
         self.log_message("Starting recognition...")
-        try:
-            recognize(self.recognize_file)
-            self.progress["value"] = 100
-        except Exception as e:
-            self.progress["value"] = 0
-            self.log_message(f"Recognition failed: {str(e)}")
-            messagebox.showerror("Error", f"Recognition failed: {str(e)}")
+        recognize_file = self.recognize_file
+        
+        def work(progress):
+            progress("model")
+            model = get_model()
+            embedding = get_embedding(model, recognize_file, p.MAX_SEC, progress=progress)
+            progress("scoring")
+            return get_gallery().identify(embedding)
+        
+        self.controller.jobs.submit(work, on_done=self.recognize_done, on_progress=self.show_stage,
+                                    on_error=lambda e: self.job_failed("Recognition", e))
+    
+    def recognize_done(self, result):
+        speaker, distance = result
+        self.progress["value"] = 100
+        if speaker is not None and distance < p.THRESHOLD:
+            self.log_message(f"Recognized: {speaker} (score {distance:.3f})")
+        else:
+            self.log_message(f"Could not identify the user (score {distance})")
 
 if __name__ == "__main__":
     root = tk.Tk()
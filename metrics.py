@@ -0,0 +1,179 @@
+import json
+import os
+import threading
+import time
+
+import parameters as p
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DURATION_BUCKETS = (0.5, 1, 2, 3, 5, 10, 20, 30, 60, 300, 3600)
+WIDTH_BUCKETS = (100, 200, 300, 400, 500, 600, 700, 800, 900, 1000)
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+SCORE_BUCKETS = (0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4, 0.5, 0.6, 0.8, 1.0, 1.5, 2.0)
+
+
+class Histogram:
+    """Cumulative Prometheus-style histogram, optionally split by one label"""
+
+    def __init__(self, name, help, buckets, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, value, label_value=None):
+        with self.lock:
+            counts, total = self.series.get(label_value, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.series[label_value] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_value, (counts, total) in sorted(self.series.items(), key=lambda item: str(item[0])):
+                labels = f'{self.label}="{label_value}",' if self.label else ""
+                for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                    lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {count}')
+                labels = f'{{{labels[:-1]}}}' if labels else ""
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+class Counter:
+    """Monotonic counter, optionally split by one label"""
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_value, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+                labels = f'{{{self.label}="{label_value}"}}' if self.label else ""
+                lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+stage_seconds = Histogram("voice_auth_stage_seconds", "Wall time per pipeline stage", TIME_BUCKETS, "stage")
+audio_seconds = Histogram("voice_auth_audio_seconds", "Duration of decoded audio", DURATION_BUCKETS)
+bucket_width = Histogram("voice_auth_bucket_width_frames", "Spectrogram width chosen from buckets()", WIDTH_BUCKETS)
+gallery_scanned = Histogram("voice_auth_gallery_scanned", "Gallery size per identification", SIZE_BUCKETS)
+scores = Histogram("voice_auth_score", "Best distance per identification", SCORE_BUCKETS)
+errors = Counter("voice_auth_errors_total", "Failures per pipeline stage", "stage")
+ALL_METRICS = (stage_seconds, audio_seconds, bucket_width, gallery_scanned, scores, errors)
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+_trace = threading.local()
+
+
+class StageTimer:
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        stage_seconds.observe(elapsed, self.stage)
+        if exc_type is not None:
+            errors.inc(self.stage)
+        trace = getattr(_trace, "fields", None)
+        if trace is not None:
+            trace.setdefault("stages", {})[self.stage] = trace.get("stages", {}).get(self.stage, 0) + elapsed
+        return False
+
+
+def timer(stage):
+    """Context manager timing one stage; a shared no-op when metrics are disabled"""
+    if not p.METRICS_ENABLED:
+        return NULL_TIMER
+    return StageTimer(stage)
+
+
+def record_stage(stage, seconds):
+    """Record a stage duration measured elsewhere"""
+    if p.METRICS_ENABLED:
+        stage_seconds.observe(seconds, stage)
+        trace = getattr(_trace, "fields", None)
+        if trace is not None:
+            trace.setdefault("stages", {})[stage] = trace.get("stages", {}).get(stage, 0) + seconds
+
+
+def observe(histogram, value):
+    """Record value in histogram, and in the current trace if one is open"""
+    if p.METRICS_ENABLED:
+        histogram.observe(value)
+        trace = getattr(_trace, "fields", None)
+        if trace is not None:
+            trace[histogram.name] = value
+
+
+def error(stage):
+    """Count a failure in stage"""
+    if p.METRICS_ENABLED:
+        errors.inc(stage)
+
+
+def trace_value(value):
+    if hasattr(value, "shape"):
+        return "<buffer {}>".format(value.shape)
+    return str(value)
+
+
+def begin_trace(**fields):
+    """Start collecting stage timings for the current request on this thread"""
+    if p.METRICS_ENABLED and p.TRACE_LOG:
+        _trace.fields = dict(fields, start=time.time())
+
+
+def end_trace(**fields):
+    """Append the current request's trace as one JSON line to p.TRACE_LOG"""
+    trace = getattr(_trace, "fields", None)
+    if trace is None:
+        return
+    _trace.fields = None
+    trace.update(fields)
+    trace["seconds"] = time.time() - trace["start"]
+    with open(p.TRACE_LOG, "a") as f:
+        f.write(json.dumps(trace, default=trace_value) + "\n")
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(path=None):
+    """Atomically write the Prometheus text to path, for a node_exporter textfile collector"""
+    path = path or p.METRICS_FILE
+    with open(path + ".tmp", "w") as f:
+        f.write(render())
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,257 @@
+import argparse
+import os
+import threading
+import time
+import numpy as np
+
+from feature_extraction import buckets
+import parameters as p
+
+
+def model_identity(model_file):
+    """Path, size and mtime of the files that define a SavedModel (or a single model file), used in cache keys"""
+    identity = [os.path.abspath(model_file)]
+    if os.path.isfile(model_file):
+        stat = os.stat(model_file)
+        identity.append((stat.st_size, stat.st_mtime_ns))
+    for name in ('saved_model.pb', os.path.join('variables', 'variables.index')):
+        path = os.path.join(model_file, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            identity.append((name, stat.st_size, stat.st_mtime_ns))
+    return repr(identity)
+
+
+class VoiceModel:
+    """TensorFlow backend: SavedModel loaded once, with one traced function per bucket width kept resident
+
+    The serving signature accepts any width, so every new clip length would otherwise run
+    shape inference again. Here each width is traced once into a function with a fixed
+    (batch, NUM_FFT, width, 1) shape; compiles and hits count how often that was needed.
+    """
+
+    backend = "tensorflow"
+
+    def __init__(self, model_file):
+        self.model_file = model_file
+        self.identity = model_identity(model_file)
+        start = time.perf_counter()
+        # TensorFlow is only imported once a model is actually needed
+        import tensorflow as tf
+        self.model = tf.saved_model.load(model_file)
+        self.predict_fn = self.model.signatures['serving_default']
+        self.load_time = time.perf_counter() - start
+        self.warmup_time = 0.0
+        self.width_fns = {}
+        self.width_lock = threading.Lock()
+        self.compiles = 0
+        self.hits = 0
+
+    def width_fn(self, width):
+        """The traced function for one spectrogram width, tracing it on first use"""
+        fn = self.width_fns.get(width)
+        if fn is not None:
+            self.hits += 1
+            return fn
+        import tensorflow as tf
+        with self.width_lock:
+            fn = self.width_fns.get(width)
+            if fn is None:
+                # the batch dimension stays open, so batches of any size share the trace
+                spec = tf.TensorSpec([None, p.NUM_FFT, width, 1], tf.float32)
+                fn = tf.function(lambda x: self.predict_fn(x), input_signature=[spec]).get_concrete_function()
+                self.width_fns[width] = fn
+                self.compiles += 1
+            else:
+                self.hits += 1
+        return fn
+
+    def stats(self):
+        return {"compiles": self.compiles, "hits": self.hits, "widths": sorted(self.width_fns)}
+
+    def predict(self, batch):
+        """Embed a (batch, NUM_FFT, width, 1) array and return a (batch, dim) array"""
+        import tensorflow as tf
+        input_tensor = tf.constant(batch, dtype=tf.float32)
+        outputs = self.width_fn(batch.shape[2])(input_tensor)
+
+        # Handle different output formats
+        if len(outputs) == 1:
+            # If only one output, use it regardless of name
+            embedding = list(outputs.values())[0]
+        else:
+            # Try common output names
+            for possible_name in ['output_0', 'embedding', 'output', 'predictions']:
+                if possible_name in outputs:
+                    embedding = outputs[possible_name]
+                    break
+            else:
+                raise ValueError(f"Could not identify output layer. Available outputs: {list(outputs.keys())}")
+
+        return embedding.numpy()
+
+    def warmup(self, widths):
+        """Trace and run every bucket width up front so the first real call is not traced"""
+        start = time.perf_counter()
+        for width in widths:
+            self.predict(np.zeros((1, p.NUM_FFT, width, 1), dtype=np.float32))
+        self.warmup_time = time.perf_counter() - start
+
+
+def tflite_interpreter():
+    """The lightest TFLite interpreter installed: LiteRT, then tflite_runtime, then the one inside TensorFlow"""
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+class TFLiteModel:
+    """TFLite backend: a converted .tflite file, with one interpreter per bucket width
+
+    Interpreters are not thread-safe, so each one is used under its own lock. Its input
+    is only resized, and its tensors reallocated, when the batch size changes.
+    """
+
+    backend = "tflite"
+
+    def __init__(self, model_file):
+        self.model_file = model_file
+        self.identity = model_identity(model_file)
+        start = time.perf_counter()
+        self.interpreter_class = tflite_interpreter()
+        with open(model_file, "rb") as f:
+            self.content = f.read()
+        self.load_time = time.perf_counter() - start
+        self.warmup_time = 0.0
+        self.width_fns = {}
+        self.width_lock = threading.Lock()
+        self.compiles = 0
+        self.hits = 0
+
+    def width_fn(self, width):
+        """(interpreter, lock) for one spectrogram width, created on first use"""
+        fn = self.width_fns.get(width)
+        if fn is not None:
+            self.hits += 1
+            return fn
+        with self.width_lock:
+            fn = self.width_fns.get(width)
+            if fn is None:
+                interpreter = self.interpreter_class(model_content=self.content, num_threads=p.TFLITE_THREADS)
+                fn = self.width_fns[width] = (interpreter, threading.Lock())
+                self.compiles += 1
+            else:
+                self.hits += 1
+        return fn
+
+    def stats(self):
+        return {"compiles": self.compiles, "hits": self.hits, "widths": sorted(self.width_fns)}
+
+    def predict(self, batch):
+        """Embed a (batch, NUM_FFT, width, 1) array and return a (batch, dim) array"""
+        batch = np.asarray(batch, dtype=np.float32)
+        interpreter, lock = self.width_fn(batch.shape[2])
+        with lock:
+            input_index = interpreter.get_input_details()[0]['index']
+            if tuple(interpreter.get_input_details()[0]['shape']) != batch.shape:
+                interpreter.resize_tensor_input(input_index, batch.shape)
+                interpreter.allocate_tensors()
+            interpreter.set_tensor(input_index, batch)
+            interpreter.invoke()
+            return interpreter.get_tensor(interpreter.get_output_details()[0]['index']).copy()
+
+    def warmup(self, widths):
+        """Create and run every bucket width's interpreter up front"""
+        start = time.perf_counter()
+        for width in widths:
+            self.predict(np.zeros((1, p.NUM_FFT, width, 1), dtype=np.float32))
+        self.warmup_time = time.perf_counter() - start
+
+
+def tflite_file(model_file, quantization=None):
+    """Where the converted copy of a SavedModel is kept, e.g. voice_auth_model_cnn.int8.tflite"""
+    return "{}.{}.tflite".format(os.path.normpath(model_file), quantization or "float32")
+
+
+def convert_tflite(model_file, output, quantization=None):
+    """Convert a SavedModel to TFLite, with optional float16 or int8 post-training quantization
+
+    int8 stores the weights as int8 with dynamic-range quantization: activations stay float,
+    so no calibration set is needed. Full-integer calibration, even on every bucket width,
+    missed the 0.99 cosine bar of benchmark.py -t backends, as activation ranges differ
+    too much between utterances. Inputs and outputs stay float32 so callers do not change.
+    """
+    import tensorflow as tf
+    converter = tf.lite.TFLiteConverter.from_saved_model(model_file)
+    if quantization in ("float16", "int8"):
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization not in (None, "int8"):
+        raise ValueError(f"Unknown quantization: {quantization}")
+    content = converter.convert()
+    with open(output, "wb") as f:
+        f.write(content)
+    return len(content)
+
+
+def set_backend(name):
+    """Select a backend by CLI name: tensorflow, tflite, tflite-float16 or tflite-int8"""
+    backend, _, quantization = name.partition("-")
+    if backend not in ("tensorflow", "tflite") or quantization not in ("", "float16", "int8"):
+        raise ValueError(f"Unknown model backend: {name}")
+    p.MODEL_BACKEND = backend
+    p.TFLITE_QUANTIZATION = quantization or None
+
+
+def load_model():
+    """A new model for the backend selected in p.MODEL_BACKEND"""
+    if p.MODEL_BACKEND == "tensorflow":
+        return VoiceModel(p.MODEL_FILE)
+    elif p.MODEL_BACKEND == "tflite":
+        model_file = tflite_file(p.MODEL_FILE, p.TFLITE_QUANTIZATION)
+        if not os.path.exists(model_file):
+            raise FileNotFoundError("{} does not exist, convert it with: python model.py{}".format(
+                model_file, f" -q {p.TFLITE_QUANTIZATION}" if p.TFLITE_QUANTIZATION else ""))
+        return TFLiteModel(model_file)
+    raise ValueError(f"Unknown model backend: {p.MODEL_BACKEND}")
+
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Return the process-wide model, loading and warming it up on first use"""
+    global _model
+    with _model_lock:
+        wanted = p.MODEL_FILE if p.MODEL_BACKEND == "tensorflow" else tflite_file(p.MODEL_FILE, p.TFLITE_QUANTIZATION)
+        if _model is None or _model.model_file != wanted:
+            model = load_model()
+            if p.WARMUP_MODEL:
+                model.warmup(sorted(buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)))
+            print("Model loaded in {:.2f}s, warmed up in {:.2f}s".format(model.load_time, model.warmup_time))
+            _model = model
+        return _model
+
+
+# args() returns the args passed to the script
+def args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-q', '--quantization', help='Post-training quantization: none, float16 or int8', default='none')
+    parser.add_argument('-o', '--output', help='Output .tflite file', required=False)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = args()
+    quantization = None if args.quantization == 'none' else args.quantization
+    output = args.output or tflite_file(p.MODEL_FILE, quantization)
+    size = convert_tflite(p.MODEL_FILE, output, quantization)
+    print("Converted [{}] to [{}], {:.1f} MiB".format(p.MODEL_FILE, output, size / 2**20))
@@ -9,13 +9,80 @@ NUM_FFT = 512
 BUCKET_STEP = 1
 MAX_SEC = 10
 
+# Voice activity detection
+VAD_ENABLED = False  # drop silent frames before the FFT; re-enroll speakers after changing this
+VAD_DBFS = -55  # frames quieter than this are silence
+VAD_RELATIVE_DB = 40  # ...as are frames this far below the loudest frame of the clip
+VAD_HANGOVER_FRAMES = 5  # frames kept either side of speech, so onsets and decays survive
+
 # Model
 MODEL_FILE = "voice_auth_model_cnn"
 COST_METRIC = "cosine"  # euclidean or cosine
 INPUT_SHAPE=(NUM_FFT,None,1)
+MODEL_BACKEND = "tensorflow"  # or "tflite", a converted copy made with python model.py
+TFLITE_QUANTIZATION = None  # None, "float16" or "int8": which converted copy the tflite backend loads
+TFLITE_THREADS = None  # interpreter threads, None lets TFLite decide
+BATCH_SIZE = 32  # maximum spectrograms per serving-signature call
+WARMUP_MODEL = True  # run dummy inputs for every bucket width after loading
 
 # IO
 EMBED_LIST_FILE = "data/embed"
+GALLERY_DIR = "data/gallery"  # consolidated, memory-mapped copy of the voiceprints
+GALLERY_ENCODING = "float32"  # "int8" (4x smaller) or "float16" (2x, slow to decode in NumPy) scans a compact copy
+RERANK_TOP_K = 32  # candidates from the compact scan rescored exactly in float32
+
+# Bulk enrollment and recognition
+BULK_USE_POOL = False  # embed through the InferencePool; on 1 CPU it ran at 0.45x the in-process loop (benchmark.py -t pool)
+NUM_WORKERS = None  # decode processes of the inference pool, None uses every CPU the inference workers leave free
+BULK_REPORT_EVERY = 1000  # files between progress lines
+RECOGNIZE_TOP_K = 5  # candidates written per probe by -t recognize -f probes.csv
+
+# Approximate nearest-neighbour index
+USE_ANN_INDEX = False
+ANN_INDEX_DIR = "data/ann"
+ANN_MIN_GALLERY = 50000  # below this many speakers the exact scan is used
+ANN_NUM_LISTS = None  # None uses 4 * sqrt(gallery size)
+ANN_NPROBE = 16  # lists scanned per query, higher is slower with better recall
+ANN_TOP_K = 10
+ANN_TRAIN_SAMPLE = 100000
+ANN_TRAIN_ITERATIONS = 10
+
+# Service
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+SERVER_MAX_BATCH = 32  # largest micro-batch sent to the model
+SERVER_MAX_WAIT_MS = 5  # how long the first request in a batch waits for company
+SERVER_DSP_THREADS = 4
+
+# Inference pool
+POOL_INFERENCE_WORKERS = 1  # processes that each hold a copy of the model
+POOL_INTRA_OP_THREADS = 2  # threads per inference worker within one op (also the TFLite interpreter threads)
+POOL_INTER_OP_THREADS = 1  # ops run side by side per inference worker
+POOL_SLOTS_PER_WORKER = 4  # shared-memory spectrogram slots per front-end process
+POOL_PIN_CPUS = True  # pin every worker to its own CPUs where the OS allows it
+
+# Cache
+SPECTRUM_CACHE_BYTES = 256 * 2**20
+EMBEDDING_CACHE_BYTES = 16 * 2**20
+CACHE_DIR = None  # directory for the on-disk cache tier, or None to keep it in memory only
+
+# Metrics
+METRICS_ENABLED = False  # stage timings, score and size histograms, error counts
+METRICS_FILE = "metrics.prom"  # Prometheus text file written by the CLI
+TRACE_LOG = None  # path of a JSONL per-request trace, or None
+
+# Evaluation
+EVAL_BINS = 20000  # histogram bins over the distance range, the resolution of the reported thresholds
+EVAL_MEMORY_MB = 512  # cap on the block of pair scores held at once
 
 # Recognition
-THRESHOLD = 0.35
\ No newline at end of file
+THRESHOLD = 0.35
+
+# Streaming
+VOICED_DBFS = -50  # frames louder than this count towards the early-decision minimum
+EARLY_DECISION_MARGIN = 0.05  # stop recording early once the distance is this far below THRESHOLD
+STREAM_POLL_MS = 250
+STREAM_WINDOW_SEC = 3  # sliding-window length for long recordings, rounded down to a bucket
+STREAM_HOP_SEC = 1
+STREAM_BLOCK_SEC = 10  # audio decoded at a time
+STREAM_MIN_VOICED = 0.5  # windows with a smaller fraction of voiced frames are not embedded
\ No newline at end of file
@@ -1,54 +1,305 @@
-import librosa
+import time
+from math import gcd
 import numpy as np
-from scipy.signal import lfilter, butter
+from scipy.fft import rfft
 from python_speech_features import sigproc
 
+from cache import audio_digest, spectrum_cache, spectrum_key
+import metrics
 import parameters as p
 
 
+def resample(audio, orig_sr, target_sr):
+    """Resample to target_sr with soxr if it is installed, else scipy's polyphase filter, returning float32"""
+    if orig_sr == target_sr:
+        return audio
+    try:
+        import soxr
+    except ImportError:
+        from scipy.signal import resample_poly
+
+        g = gcd(int(orig_sr), int(target_sr))
+        return resample_poly(audio, int(target_sr) // g, int(orig_sr) // g).astype(np.float32)
+    return soxr.resample(audio, orig_sr, target_sr, 'HQ').astype(np.float32, copy=False)
+
+
+def block_resampler(orig_sr, target_sr):
+    """A function resample(block, last) for consecutive blocks of one signal, returning float32
+
+    soxr's stream keeps its filter state between blocks, so the output matches resampling the
+    whole signal at once. Without soxr each block is resampled on its own.
+    """
+    if orig_sr == target_sr:
+        return lambda block, last=False: block
+    try:
+        import soxr
+    except ImportError:
+        return lambda block, last=False: resample(block, orig_sr, target_sr) if len(block) else block
+    stream = soxr.ResampleStream(orig_sr, target_sr, 1, dtype='float32', quality='HQ')
+    return lambda block, last=False: stream.resample_chunk(block, last=last)
+
+
+def downmix(audio):
+    """Average a (samples, channels) array to mono; a matrix-vector product beats mean(axis=1) here"""
+    if audio.shape[1] == 1:
+        return audio[:, 0]
+    return audio @ np.full(audio.shape[1], 1 / audio.shape[1], dtype=np.float32)
+
+
+def decode(filename, sample_rate):
+    """Mono float32 audio at sample_rate, plus the seconds spent reading, downmixing and resampling
+
+    soundfile reads the file natively; librosa (and its decoders) is only used for formats
+    libsndfile cannot open. Files already at sample_rate are not resampled at all.
+    """
+    import soundfile as sf
+
+    costs = {"read": 0.0, "downmix": 0.0, "resample": 0.0}
+    start = time.perf_counter()
+    try:
+        audio, rate = sf.read(filename, dtype='float32', always_2d=True)
+        costs["decoder"] = "soundfile"
+    except (RuntimeError, sf.LibsndfileError):
+        # librosa is slow to import, so it is only loaded when soundfile cannot decode a file
+        import librosa
+
+        audio, rate = librosa.load(filename, sr=None, mono=False, dtype=np.float32)
+        audio = np.atleast_2d(audio).T
+        costs["decoder"] = "librosa"
+    costs["read"] = time.perf_counter() - start
+    costs["source_rate"], costs["channels"] = rate, audio.shape[1]
+
+    start = time.perf_counter()
+    audio = downmix(audio)
+    costs["downmix"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    audio = resample(audio, rate, sample_rate)
+    costs["resample"] = time.perf_counter() - start
+    return audio, costs
+
+
 def load(filename, sample_rate):
-    audio, sr = librosa.load(filename, sr=sample_rate, mono=True)
-    audio = audio.flatten()
-    return audio
+    return decode(filename, sample_rate)[0]
+
+
+def read_blocks(filename, block_sec=None):
+    """Yield mono float32 blocks at p.SAMPLE_RATE from an audio file, without decoding all of it
+
+    Formats libsndfile cannot open are decoded whole, as in decode, and then split into blocks.
+    """
+    import soundfile as sf
+
+    block_sec = block_sec or p.STREAM_BLOCK_SEC
+    try:
+        f = sf.SoundFile(filename)
+    except (RuntimeError, sf.LibsndfileError):
+        audio = load(filename, p.SAMPLE_RATE)
+        step = int(block_sec * p.SAMPLE_RATE)
+        for start in range(0, len(audio), step):
+            yield audio[start:start + step]
+        return
+    with f:
+        rate = f.samplerate
+        resample_block = block_resampler(rate, p.SAMPLE_RATE)
+        for block in f.blocks(blocksize=int(block_sec * rate), dtype='float32', always_2d=True):
+            yield resample_block(downmix(block))
+        # the resampler holds back its last few samples until it is told the signal has ended
+        yield resample_block(np.zeros(0, dtype=np.float32), last=True)
+
+
+def load_buffer(audio, sample_rate):
+    """Bring an in-memory capture to a flat mono signal at p.SAMPLE_RATE"""
+    audio = np.asarray(audio, dtype=np.float32)
+    if audio.ndim > 1:
+        audio = downmix(audio)
+    return resample(audio, sample_rate, p.SAMPLE_RATE)
 
 
 def normalize_frames(m,epsilon=1e-12):
-    return np.array([(v - np.mean(v)) / max(np.std(v),epsilon) for v in m])
+    m = np.asarray(m)
+    return (m - m.mean(axis=1, keepdims=True)) / np.maximum(m.std(axis=1, keepdims=True), epsilon)
 
 
-# Valuable dc and dither removal function implemented 
-# https://github.com/christianvazquez7/ivector/blob/master/MSRIT/rm_dc_n_dither.m
-def remove_dc_and_dither(sin, sample_rate):
+def dc_alpha(sample_rate):
     if sample_rate == 16e3:
-        alpha = 0.99
+        return 0.99
     elif sample_rate == 8e3:
-        alpha = 0.999
-    else:
-        print("Sample rate must be 16kHz or 8kHz only")
-        exit(1)
-    sin = lfilter([1,-1], [1,-alpha], sin)
+        return 0.999
+    # other rates keep the time constant of the 16kHz filter
+    return 0.99 ** (16e3 / sample_rate)
+
+
+def add_dither(sin):
     dither = np.random.random_sample(len(sin)) + np.random.random_sample(len(sin)) - 1
     spow = np.std(dither)
-    sout = sin + 1e-6 * spow * dither
-    return sout
+    # keep the caller's dtype so a float32 signal stays float32
+    return sin + (1e-6 * spow * dither).astype(sin.dtype)
+
+
+# Valuable dc and dither removal function implemented 
+# https://github.com/christianvazquez7/ivector/blob/master/MSRIT/rm_dc_n_dither.m
+def remove_dc_and_dither(sin, sample_rate):
+    from scipy.signal import lfilter
+
+    alpha = dc_alpha(sample_rate)
+    sin = lfilter(np.array([1,-1], dtype=sin.dtype), np.array([1,-alpha], dtype=sin.dtype), sin)
+    return add_dither(sin)
+
+
+def get_fft_spectrum(filename, buckets, sample_rate=None, progress=None):
+    """Spectrum of an audio file, or of a NumPy buffer recorded at sample_rate
+
+    progress, if given, is called with "decode" and "features" before each stage.
+    """
+    key = spectrum_key(audio_digest(filename, sample_rate), buckets)
+    out = spectrum_cache.get(key)
+    if out is None:
+        if progress:
+            progress("decode")
+        with metrics.timer("decode"):
+            if isinstance(filename, np.ndarray):
+                signal = load_buffer(filename, sample_rate or p.SAMPLE_RATE)
+            else:
+                signal, costs = decode(filename, p.SAMPLE_RATE)
+                metrics.record_stage("decode_read", costs["read"])
+                metrics.record_stage("decode_resample", costs["resample"])
+        metrics.observe(metrics.audio_seconds, len(signal) / p.SAMPLE_RATE)
+        if progress:
+            progress("features")
+        with metrics.timer("features"):
+            out = fft_spectrum(signal, buckets)
+        metrics.observe(metrics.bucket_width, out.shape[1])
+        spectrum_cache.put(key, out)
+    return out
+
+
+def frame_signal(signal):
+    """Unwindowed frames as a strided view, laid out and zero-padded exactly like sigproc.framesig"""
+    frame_len = int(sigproc.round_half_up(p.FRAME_LEN*p.SAMPLE_RATE))
+    frame_step = int(sigproc.round_half_up(p.FRAME_STEP*p.SAMPLE_RATE))
+    num_frames = 1 if len(signal) <= frame_len else 1 + int(np.ceil((len(signal) - frame_len) / frame_step))
+    padded = np.concatenate([signal, np.zeros((num_frames - 1) * frame_step + frame_len - len(signal), dtype=signal.dtype)])
+    return np.lib.stride_tricks.sliding_window_view(padded, frame_len)[::frame_step]
+
+
+def frame_dbfs(frames):
+    """Level of each frame of 2**15-scaled samples, in dB relative to full scale"""
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=1)) / 2**15
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def speech_mask(levels, min_frames):
+    """Frames louder than p.VAD_DBFS and within p.VAD_RELATIVE_DB of the loudest, widened by the hangover
+
+    Keeps every frame instead if fewer than min_frames would survive.
+    """
+    voiced = (levels > p.VAD_DBFS) & (levels > levels.max() - p.VAD_RELATIVE_DB)
+    if p.VAD_HANGOVER_FRAMES:
+        voiced = np.convolve(voiced, np.ones(2 * p.VAD_HANGOVER_FRAMES + 1), mode="same") > 0
+    if voiced.sum() < min_frames:
+        return np.ones(len(levels), dtype=bool)
+    return voiced
 
 
-def get_fft_spectrum(filename, buckets):
-    signal = load(filename,p.SAMPLE_RATE)
+def fft_spectrum(signal, buckets):
+    signal = signal.astype(np.float32)
     signal *= 2**15
 
     # get FFT spectrum
     signal = remove_dc_and_dither(signal, p.SAMPLE_RATE)
     signal = sigproc.preemphasis(signal, coeff=p.PREEMPHASIS_ALPHA)
-    frames = sigproc.framesig(signal, frame_len=p.FRAME_LEN*p.SAMPLE_RATE, frame_step=p.FRAME_STEP*p.SAMPLE_RATE, winfunc=np.hamming)
-    fft = abs(np.fft.fft(frames,n=p.NUM_FFT))
-    fft_norm = normalize_frames(fft.T)
+    if p.VAD_ENABLED:
+        # drop silence and pauses before any frame is windowed or transformed
+        frames = frame_signal(signal)
+        frames = frames[speech_mask(frame_dbfs(frames), min(buckets))] * np.hamming(frames.shape[1]).astype(np.float32)
+    else:
+        frames = sigproc.framesig(signal, frame_len=p.FRAME_LEN*p.SAMPLE_RATE, frame_step=p.FRAME_STEP*p.SAMPLE_RATE, winfunc=np.hamming)
+    # the input is real, so only the non-negative half of the spectrum is computed
+    fft = np.abs(rfft(frames.astype(np.float32), n=p.NUM_FFT, axis=1))
+    return truncate_spectrum(fft, buckets)
+
+
+def truncate_spectrum(fft, buckets):
+    """Normalize (frames, bins) half-spectrum magnitudes and cut them to the largest bucket that fits"""
+    return bucket_slice(normalize_frames(fft.T), buckets)
+
 
+def bucket_slice(fft_norm, buckets):
     # truncate to max bucket sizes
     rsize = max(k for k in buckets if k <= fft_norm.shape[1])
     rstart = int((fft_norm.shape[1]-rsize)/2)
     out = fft_norm[:,rstart:rstart+rsize]
 
-    return out
+    # rebuild the mirrored negative-frequency rows the model expects
+    return np.concatenate([out, out[(p.NUM_FFT-1)//2:0:-1]])
+
+
+class StreamingSpectrum:
+    """Incremental version of fft_spectrum that turns audio chunks into spectrogram columns
+
+    The DC filter, pre-emphasis and partial-frame state is carried across chunks,
+    so a capture can be scored while it is still being recorded. Audio must be
+    mono at p.SAMPLE_RATE.
+    """
+
+    def __init__(self):
+        alpha = dc_alpha(p.SAMPLE_RATE)
+        self.dc_b = np.array([1, -1], dtype=np.float32)
+        self.dc_a = np.array([1, -alpha], dtype=np.float32)
+        self.dc_state = np.zeros(1, dtype=np.float32)
+        self.last_sample = None
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.frame_len = int(round(p.FRAME_LEN * p.SAMPLE_RATE))
+        self.frame_step = int(round(p.FRAME_STEP * p.SAMPLE_RATE))
+        self.window = np.hamming(self.frame_len).astype(np.float32)
+        self.blocks = []
+        self.levels = []
+        self.num_frames = 0
+        self.voiced_frames = 0
+
+    def feed(self, chunk):
+        """Add raw samples in [-1, 1] and return the number of new spectrogram columns"""
+        chunk = np.asarray(chunk, dtype=np.float32).reshape(-1) * 2**15
+        if len(chunk) == 0:
+            return 0
+        from scipy.signal import lfilter
+
+        signal, self.dc_state = lfilter(self.dc_b, self.dc_a, chunk, zi=self.dc_state)
+        signal = add_dither(signal)
+
+        # pre-emphasis continues from the last sample of the previous chunk
+        previous = signal[0] if self.last_sample is None else self.last_sample
+        emphasized = signal - p.PREEMPHASIS_ALPHA * np.concatenate([[previous], signal[:-1]]).astype(np.float32)
+        if self.last_sample is None:
+            emphasized[0] = signal[0]
+        self.last_sample = signal[-1]
+
+        samples = np.concatenate([self.pending, emphasized])
+        if len(samples) < self.frame_len:
+            self.pending = samples
+            return 0
+        count = 1 + (len(samples) - self.frame_len) // self.frame_step
+        frames = np.lib.stride_tricks.sliding_window_view(samples, self.frame_len)[::self.frame_step][:count]
+        self.pending = samples[count * self.frame_step:]
+
+        levels = frame_dbfs(frames)
+        self.levels.append(levels)
+        self.voiced_frames += int(np.sum(levels > p.VOICED_DBFS))
+        self.blocks.append(np.abs(rfft(frames * self.window, n=p.NUM_FFT, axis=1)))
+        self.num_frames += count
+        return count
 
+    def drain(self):
+        """Return the (frames, bins) magnitudes and frame levels fed since the last drain, and forget them"""
+        fft = np.concatenate(self.blocks) if self.blocks else np.zeros((0, p.NUM_FFT // 2 + 1), dtype=np.float32)
+        levels = np.concatenate(self.levels) if self.levels else np.zeros(0, dtype=np.float32)
+        self.blocks, self.levels = [], []
+        return fft, levels
 
+    def spectrum(self, buckets):
+        """Spectrum of everything fed so far, in the same layout as get_fft_spectrum"""
+        fft = np.concatenate(self.blocks)
+        if p.VAD_ENABLED:
+            fft = fft[speech_mask(np.concatenate(self.levels), min(buckets))]
+        return truncate_spectrum(fft, buckets)
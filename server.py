@@ -0,0 +1,216 @@
+# IMPORT SYSTEM FILES
+import argparse
+import asyncio
+import base64
+import json
+import os
+import warnings
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Suppress warnings and logging
+logging.basicConfig(level=logging.ERROR)
+warnings.filterwarnings("ignore")
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # FATAL
+logging.getLogger('tensorflow').setLevel(logging.FATAL)
+
+# IMPORT USER-DEFINED FUNCTIONS
+from feature_extraction import buckets, embed_spectra
+from gallery import check_name, get_gallery
+import metrics
+from model import get_model, set_backend
+from preprocess import get_fft_spectrum
+import parameters as p
+
+
+class NotFound(Exception):
+    """A request for something that does not exist, answered with 404"""
+
+
+class MicroBatcher:
+    """Coalesces spectra from concurrent requests into batched model calls"""
+
+    def __init__(self, model, max_batch=None, max_wait_ms=None):
+        self.model = model
+        self.max_batch = max_batch or p.SERVER_MAX_BATCH
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else p.SERVER_MAX_WAIT_MS) / 1000
+        self.queue = asyncio.Queue()
+        # a single inference thread, the model call itself is multi-threaded
+        self.executor = ThreadPoolExecutor(1)
+        self.batches = 0
+        self.items = 0
+        self.batch_sizes = {}
+
+    async def embed(self, spectrum):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((spectrum, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            spectra = [spectrum for spectrum, _ in batch]
+            try:
+                with metrics.timer("batch_inference"):
+                    embeddings = await loop.run_in_executor(self.executor, embed_spectra, self.model, spectra, self.max_batch)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.cancelled():
+                    future.set_result(embedding)
+
+            self.batches += 1
+            self.items += len(batch)
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+
+    def stats(self):
+        return {"queue_depth": self.queue.qsize(), "batches": self.batches, "items": self.items,
+                "mean_batch_size": self.items / max(self.batches, 1),
+                "batch_sizes": {str(k): v for k, v in sorted(self.batch_sizes.items())}}
+
+
+class VoiceAuthService:
+    """enroll / verify / identify over HTTP, with the model and gallery held in memory"""
+
+    def __init__(self):
+        self.model = get_model()
+        self.gallery = get_gallery()
+        self.batcher = MicroBatcher(self.model)
+        self.buckets = buckets(p.MAX_SEC, p.BUCKET_STEP, p.FRAME_STEP)
+        self.dsp_executor = ThreadPoolExecutor(p.SERVER_DSP_THREADS)
+        # scoring may build the compact copy or the ANN index on first use, so it stays off the event loop too
+        self.score_executor = ThreadPoolExecutor(p.SERVER_DSP_THREADS)
+        # gallery writes take a file lock and flush memmaps, so they stay off the event loop
+        self.write_executor = ThreadPoolExecutor(1)
+        self.requests = 0
+        self.errors = 0
+
+    async def embedding(self, request):
+        """Decode the audio named by the request ("file", or base64 float32 "audio" + "sample_rate")"""
+        if "audio" in request:
+            source = np.frombuffer(base64.b64decode(request["audio"]), dtype=np.float32)
+            sample_rate = request.get("sample_rate", p.SAMPLE_RATE)
+        else:
+            source, sample_rate = request["file"], None
+        spectrum = await asyncio.get_running_loop().run_in_executor(
+            self.dsp_executor, get_fft_spectrum, source, self.buckets, sample_rate)
+        return await self.batcher.embed(spectrum)
+
+    async def enroll(self, request):
+        name = check_name(request["name"])
+        embedding = await self.embedding(request)
+        await asyncio.get_running_loop().run_in_executor(
+            self.write_executor, self.gallery.add_sample, name, embedding, p.EMBED_LIST_FILE)
+        return {"enrolled": name, "samples": self.gallery.samples(name), "spread": self.gallery.spread(name)}
+
+    async def verify(self, request):
+        name = request["name"]
+        embedding = await self.embedding(request)
+        # verify() reloads the gallery first, so a speaker enrolled by another process is found
+        score = await asyncio.get_running_loop().run_in_executor(self.score_executor, self.gallery.verify, name, embedding)
+        if score is None:
+            raise NotFound(f"{name} is not enrolled")
+        return {"name": name, "score": score, "accepted": score < p.THRESHOLD}
+
+    async def identify(self, request):
+        embedding = await self.embedding(request)
+        speaker, score = await asyncio.get_running_loop().run_in_executor(
+            self.score_executor, self.gallery.identify, embedding)
+        accepted = score is not None and score < p.THRESHOLD
+        return {"name": speaker if accepted else None, "closest": speaker, "score": score, "accepted": accepted}
+
+    def stats(self):
+        return {"requests": self.requests, "errors": self.errors, "enrolled": len(self.gallery),
+                "model": self.model.stats(), **self.batcher.stats()}
+
+    async def dispatch(self, method, path, body):
+        routes = {"/enroll": self.enroll, "/verify": self.verify, "/identify": self.identify}
+        if method == "GET" and path == "/stats":
+            return 200, self.stats()
+        if method == "GET" and path == "/metrics":
+            return 200, metrics.render()
+        if method != "POST" or path not in routes:
+            return 404, {"error": f"no route for {method} {path}"}
+        self.requests += 1
+        try:
+            return 200, await routes[path](json.loads(body or b"{}"))
+        except Exception as e:
+            self.errors += 1
+            metrics.error(path.strip("/"))
+            return 404 if isinstance(e, NotFound) else 400, {"error": str(e)}
+
+    async def handle(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection until the client closes it"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode().split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, response = await self.dispatch(method, path, body)
+                if isinstance(response, str):
+                    payload, content_type = response.encode(), b"text/plain; version=0.0.4"
+                else:
+                    payload, content_type = json.dumps(response).encode(), b"application/json"
+                writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n"
+                             % (status, b"OK" if status == 200 else b"Error", content_type, len(payload)) + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=None, port=None, socket_path=None):
+        asyncio.get_running_loop().create_task(self.batcher.run())
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle, path=socket_path)
+            print(f"Serving on unix socket {socket_path}")
+        else:
+            server = await asyncio.start_server(self.handle, host or p.SERVER_HOST, port or p.SERVER_PORT)
+            print("Serving on http://{}:{}".format(*server.sockets[0].getsockname()[:2]))
+        async with server:
+            await server.serve_forever()
+
+
+# args() returns the args passed to the script
+def args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', help='Address to listen on', default=p.SERVER_HOST)
+    parser.add_argument('--port', help='TCP port to listen on', type=int, default=p.SERVER_PORT)
+    parser.add_argument('--socket', help='Listen on this Unix socket instead of TCP', required=False)
+    parser.add_argument('--backend', help='Inference backend: tensorflow, tflite, tflite-float16 or tflite-int8', default=None)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = args()
+    if args.backend:
+        set_backend(args.backend)
+    os.makedirs(p.EMBED_LIST_FILE, exist_ok=True)
+    asyncio.run(VoiceAuthService().serve(args.host, args.port, args.socket))
@@ -3,8 +3,6 @@ import argparse
 import os
 import numpy as np
 import warnings
-import tensorflow as tf
-from scipy.spatial.distance import euclidean
 import logging
 
 # Suppress warnings and logging
@@ -14,120 +12,233 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # FATAL
 logging.getLogger('tensorflow').setLevel(logging.FATAL)
 
 # IMPORT USER-DEFINED FUNCTIONS
-from feature_extraction import get_embedding, get_embeddings_from_list_file
+from bulk_enroll import enroll_manifest
+from bulk_recognize import recognize_manifest
+from feature_extraction import get_embedding, window_embeddings
+from gallery import check_name, get_gallery
+from model import get_model, set_backend, tflite_file
+import metrics
 import parameters as p
 
 # Set the model directory path
 p.MODEL_FILE = 'voice_auth_model_cnn'  # Point to the directory, not the file
-print("Model directory path:", p.MODEL_FILE)
 
-# Check if the model directory exists
-if not os.path.exists(p.MODEL_FILE):
-    print(f"Error: The directory {p.MODEL_FILE} does not exist.")
-    exit()
+def check_model():
+    """Exit early if the model directory is missing, before any task starts"""
+    if p.MODEL_BACKEND == "tflite":
+        model_file = tflite_file(p.MODEL_FILE, p.TFLITE_QUANTIZATION)
+        print("Model file path:", model_file)
+        if not os.path.exists(model_file):
+            print(f"Error: The file {model_file} does not exist. Convert the model first with python model.py")
+            exit()
+        return
+
+    print("Model directory path:", p.MODEL_FILE)
+
+    # Check if the model directory exists
+    if not os.path.exists(p.MODEL_FILE):
+        print(f"Error: The directory {p.MODEL_FILE} does not exist.")
+        exit()
 
-# Check if the saved_model.pb file exists
-if not os.path.exists(os.path.join(p.MODEL_FILE, 'saved_model.pb')):
-    print(f"Error: The file saved_model.pb does not exist in {p.MODEL_FILE}.")
-    exit()
+    # Check if the saved_model.pb file exists
+    if not os.path.exists(os.path.join(p.MODEL_FILE, 'saved_model.pb')):
+        print(f"Error: The file saved_model.pb does not exist in {p.MODEL_FILE}.")
+        exit()
 
 # args() returns the args passed to the script
 def args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-t', '--task', help='Task to do. Either "enroll" or "recognize"', required=True)
+    parser.add_argument('-t', '--task', help='Task to do. One of "enroll", "recognize", "verify" or "search"', required=True)
     parser.add_argument('-n', '--name', help='Specify the name of the person you want to enroll', required=False)
     parser.add_argument('-f', '--file', help='Specify the audio file you want to enroll', required=True)
+    parser.add_argument('-o', '--output', help='Results file of recognize with a CSV list: .csv or .jsonl (default <list>.results.csv)', required=False)
+    parser.add_argument('-k', '--top-k', help='Candidates written per probe by recognize with a CSV list', type=int, default=p.RECOGNIZE_TOP_K)
+    parser.add_argument('-b', '--backend', help='Inference backend: tensorflow, tflite, tflite-float16 or tflite-int8', default=None)
     return parser.parse_args()
 
-def enroll(name, file):
-    """Enroll a user with an audio file"""
+def save_voiceprint(speaker, embedding):
+    """Add an enrollment sample to a speaker's voiceprint and write the new centroid to data/embed"""
+    gallery = get_gallery()
+    # the .npy is written inside the gallery transaction, so the two never disagree
+    gallery.add_sample(speaker, embedding, p.EMBED_LIST_FILE)
+    return gallery.samples(speaker)
+
+def enroll(name, file, sample_rate=None):
+    """Enroll a user with an audio file, or a NumPy buffer recorded at sample_rate"""
     print("Loading model weights from [{}]....".format(p.MODEL_FILE))
     try:
-        model = tf.saved_model.load(p.MODEL_FILE)
-        predict_fn = model.signatures['serving_default']
+        model = get_model()
     except Exception as e:
         print(f"Failed to load weights from the weights file: {e}")
         exit()
     
+    metrics.begin_trace(task="enroll", name=name, file=file)
     try:
         print("Processing enroll sample....")
-        enroll_result = get_embedding(model, file, p.MAX_SEC)
+        enroll_result = get_embedding(model, file, p.MAX_SEC, sample_rate)
         enroll_embs = np.array(enroll_result.tolist())
         speaker = name
     except Exception as e:
         print(f"Error processing the input audio file: {e}")
+        metrics.end_trace(error=str(e))
         return
     
     try:
-        np.save(os.path.join(p.EMBED_LIST_FILE, f"{speaker}.npy"), enroll_embs)
-        print("Successfully enrolled the user")
+        samples = save_voiceprint(speaker, enroll_embs)
+        print("Successfully enrolled the user ({} sample{})".format(samples, "" if samples == 1 else "s"))
+        metrics.end_trace()
     except Exception as e:
         print(f"Unable to save the user into the database: {e}")
+        metrics.end_trace(error=str(e))
 
 def enroll_csv(csv_file):
     """Enroll a list of users using a CSV file"""
-    print("Getting the model weights from [{}]".format(p.MODEL_FILE))
+    print("Processing enroll samples with the model weights from [{}]....".format(p.MODEL_FILE))
     try:
-        model = tf.saved_model.load(p.MODEL_FILE)
+        enrolled, failed = enroll_manifest(csv_file)
+        print(f"Successfully enrolled {enrolled} samples, {failed} failed")
     except Exception as e:
-        print(f"Failed to load weights from the weights file: {e}")
+        print(f"Unable to enroll the users: {e}")
+
+def recognize(file, sample_rate=None):
+    """Recognize the input audio file (or NumPy buffer) by comparing to saved users' voice prints"""
+    gallery = get_gallery()
+    if len(gallery) == 0:
+        print("No enrolled users found")
         exit()
     
-    print("Processing enroll samples....")
+    print("Loading model weights from [{}]....".format(p.MODEL_FILE))
     try:
-        enroll_results = get_embeddings_from_list_file(model, csv_file, p.MAX_SEC)
-        enroll_embs = np.array([emb.tolist() for emb in enroll_results['embedding']])
-        speakers = enroll_results['speaker']
+        model = get_model()
     except Exception as e:
-        print(f"Error processing the input audio files: {e}")
-        return
+        print(f"Failed to load weights from the weights file: {e}")
+        exit()
     
+    print("Processing test sample....")
+    print("Comparing test sample against enroll samples....")
+    metrics.begin_trace(task="recognize", file=file)
     try:
-        for i, speaker in enumerate(speakers):
-            np.save(os.path.join(p.EMBED_LIST_FILE, f"{speaker}.npy"), enroll_embs[i])
-            print(f"Successfully enrolled the user: {speaker}")
+        test_result = get_embedding(model, file, p.MAX_SEC, sample_rate)
+        test_embs = np.array(test_result.tolist())
     except Exception as e:
-        print(f"Unable to save the user into the database: {e}")
+        print(f"Error processing the test audio file: {e}")
+        metrics.end_trace(error=str(e))
+        return
+    
+    # Score against every enrolled speaker in one vectorized pass
+    speaker, distance = gallery.identify(test_embs)
+    metrics.end_trace(speaker=speaker, score=distance, accepted=distance < p.THRESHOLD)
+    if distance < p.THRESHOLD:
+        print("Recognized:", speaker)
+    else:
+        print("Could not identify the user, try enrolling again with a clear voice sample")
+        print("Score:", distance)
 
-def recognize(file):
-    """Recognize the input audio file by comparing to saved users' voice prints"""
-    if os.path.exists(p.EMBED_LIST_FILE):
-        embeds = os.listdir(p.EMBED_LIST_FILE)
-    if len(embeds) == 0:
+def recognize_csv(csv_file, output=None, k=None):
+    """Recognize every file of a CSV list in batches, streaming the top-k speakers of each to output"""
+    gallery = get_gallery()
+    if len(gallery) == 0:
         print("No enrolled users found")
         exit()
+    output = output or os.path.splitext(csv_file)[0] + ".results.csv"
+    
+    print("Comparing test samples against {} enrolled users....".format(len(gallery)))
+    try:
+        recognized, accepted, failed = recognize_manifest(csv_file, output, k)
+        print(f"Recognized {accepted} of {recognized} samples, {failed} failed, results in {output}")
+    except Exception as e:
+        print(f"Unable to recognize the samples: {e}")
+
+def verify(name, file, sample_rate=None):
+    """Check an audio file (or NumPy buffer) against one claimed user's voice print, returning the score"""
+    gallery = get_gallery()
+    if name not in gallery.rows:
+        print(f"User {name} is not enrolled")
+        return None
     
     print("Loading model weights from [{}]....".format(p.MODEL_FILE))
     try:
-        model = tf.saved_model.load(p.MODEL_FILE)
+        model = get_model()
     except Exception as e:
         print(f"Failed to load weights from the weights file: {e}")
         exit()
     
-    distances = {}
-    print("Processing test sample....")
-    print("Comparing test sample against enroll samples....")
+    print("Comparing test sample against {}'s enroll sample....".format(name))
+    metrics.begin_trace(task="verify", name=name, file=file)
     try:
-        test_result = get_embedding(model, file, p.MAX_SEC)
-        test_embs = np.array(test_result.tolist())
+        test_embs = get_embedding(model, file, p.MAX_SEC, sample_rate)
     except Exception as e:
         print(f"Error processing the test audio file: {e}")
-        return
-    
-    for emb in embeds:
-        try:
-            enroll_embs = np.load(os.path.join(p.EMBED_LIST_FILE, emb))
-            speaker = emb.replace(".npy", "")
-            distance = euclidean(test_embs, enroll_embs)
-            distances.update({speaker: distance})
-        except Exception as e:
-            print(f"Error loading or comparing embeddings for {emb}: {e}")
+        metrics.end_trace(error=str(e))
+        return None
     
-    if distances and min(distances.values()) < p.THRESHOLD:
-        print("Recognized:", min(distances, key=distances.get))
+    # Only the claimed speaker's row is scored, so this does not grow with the gallery
+    distance = gallery.verify(name, test_embs)
+    metrics.end_trace(score=distance, accepted=distance < p.THRESHOLD)
+    if distance < p.THRESHOLD:
+        print("Verified:", name)
     else:
-        print("Could not identify the user, try enrolling again with a clear voice sample")
-        print("Score:", min(distances.values()) if distances else "N/A")
+        print("Voice does not match", name)
+    print("Score:", distance)
+    return distance
+
+def search(file):
+    """Find where enrolled users speak in a long recording, reading it in bounded memory"""
+    import time
+
+    gallery = get_gallery()
+    if len(gallery) == 0:
+        print("No enrolled users found")
+        exit()
+    
+    print("Loading model weights from [{}]....".format(p.MODEL_FILE))
+    try:
+        model = get_model()
+    except Exception as e:
+        print(f"Failed to load weights from the weights file: {e}")
+        exit()
+    
+    print("Searching the recording for enrolled users....")
+    start = time.perf_counter()
+    segments = []
+    duration = 0.0
+
+    def progress(seconds):
+        nonlocal duration
+        duration = seconds
+
+    try:
+        for window_start, window_end, embedding in window_embeddings(model, file, progress=progress):
+            speaker, distance = gallery.identify(embedding)
+            if distance >= p.THRESHOLD:
+                continue
+            # Overlapping windows of the same speaker make one segment
+            if segments and segments[-1][2] == speaker and window_start <= segments[-1][1]:
+                segments[-1][1] = window_end
+                segments[-1][3] = min(segments[-1][3], distance)
+            else:
+                segments.append([window_start, window_end, speaker, distance])
+    except Exception as e:
+        print(f"Error processing the input audio file: {e}")
+        return None
+    elapsed = time.perf_counter() - start
+    
+    for segment_start, segment_end, speaker, distance in segments:
+        print("{:>9.2f}s - {:>9.2f}s  {}  (best score {:.4f})".format(segment_start, segment_end, speaker, distance))
+    if not segments:
+        print("No enrolled user found in the recording")
+    print("Processed {:.1f}s of audio in {:.1f}s ({:.1f} audio-seconds/sec)".format(duration, elapsed, duration / max(elapsed, 1e-9)))
+    return segments
+
+def score_spectrum(spectrum, name=None):
+    """Score an already computed spectrum, returning (speaker, distance)
+
+    With a name only that speaker is scored, otherwise the closest enrolled speaker is found.
+    """
+    embedding = np.squeeze(get_model().predict(spectrum.reshape(1, *spectrum.shape, 1)))
+    if name is not None:
+        return name, get_gallery().verify(name, embedding)
+    return get_gallery().identify(embedding)
 
 # Helper function to get file extension
 def get_extension(filename):
@@ -144,17 +255,41 @@ if __name__ == '__main__':
     task = args.task
     file = args.file
     name = args.name if args.name else None
+    if args.backend:
+        try:
+            set_backend(args.backend)
+        except ValueError as e:
+            print(e)
+            exit()
+    check_model()
 
     if get_extension(file) == 'csv':
         if task == 'enroll':
             enroll_csv(file)
         elif task == 'recognize':
-            print("Recognize argument cannot process a comma-separated file. Please specify an audio file.")
+            recognize_csv(file, args.output, args.top_k)
+        elif task in ('verify', 'search'):
+            print("{} argument cannot process a comma-separated file. Please specify an audio file.".format(task.capitalize()))
     else:
         if task == 'enroll':
             if not name:
                 print("Missing argument: -n name is required for the user name")
                 exit()
+            try:
+                check_name(name)
+            except ValueError as e:
+                print(e)
+                exit()
             enroll(name, file)
         elif task == 'recognize':
-            recognize(file)
\ No newline at end of file
+            recognize(file)
+        elif task == 'verify':
+            if not name:
+                print("Missing argument: -n name is required for the claimed user name")
+                exit()
+            verify(name, file)
+        elif task == 'search':
+            search(file)
+
+    if p.METRICS_ENABLED:
+        metrics.write_metrics()